@@ -0,0 +1,266 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+REPO_DIR = Path(__file__).resolve().parent
+NUM_ESSEN = 40 #essen scores in the fixed benchmark subset, on top of every piano score
+TOLERANCE = 0.2 #slowdown against the baseline that counts as a regression
+
+
+"""
+The fixed subset of bundled scores every benchmark runs on: the first NUM_ESSEN essen .krn files and the piano scores
+"""
+def benchmark_scores(num_essen=NUM_ESSEN):
+    essen = sorted((REPO_DIR / 'essen').rglob('*.krn'))
+    return essen[:num_essen] + sorted((REPO_DIR / 'piano').glob('*.mxl'))
+
+
+"""
+Summary statistics, in seconds, of a list of timings
+"""
+def summarize(timings):
+    timings = np.asarray(timings)
+    return {
+        'n': len(timings),
+        'mean': float(timings.mean()),
+        'median': float(np.median(timings)),
+        'p95': float(np.percentile(timings, 95)),
+        'min': float(timings.min()),
+    }
+
+
+"""
+Times fn(*args) once for every set of args
+"""
+def time_calls(fn, all_args):
+    timings = []
+    for args in all_args:
+        start = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def bench_extraction(results, scores, paths):
+    import functions
+
+    extractors = {
+        'melodic_arch': lambda s: functions.melodic_arch(s, 8),
+        'avg_phrase_length': functions.avg_phrase_length,
+        'nonharmonic_notes': functions.nonharmonic_notes,
+        'get_note_lengths': functions.get_note_lengths,
+        'get_intervals': functions.get_intervals,
+        'musical_attributes': functions.musical_attributes,
+        'metadata_attributes': functions.metadata_attributes,
+    }
+    for name, fn in extractors.items():
+        run('extract.' + name, results, lambda: time_calls(fn, [(s,) for s in scores]))
+    run('extract.extract_features', results, lambda: time_calls(functions.extract_features, zip(scores, paths)))
+
+
+def bench_score_reader(results, paths):
+    from functions import melody_features
+    from score_reader import read_melody
+
+    melodies = []
+    run('parse.score_reader', results, lambda: time_calls(lambda p: melodies.append((read_melody(p), p)), [(p,) for p in paths if p.suffix == '.krn']))
+    run('extract.melody_features', results, lambda: time_calls(melody_features, melodies))
+
+
+def bench_similarity(results, features):
+    from functions import similarity, bounded_similarity
+    from similarity_matrix import similarity_matrix
+    from topk_index import build_topk_index_from_features
+
+    pairs = list(itertools.combinations(features, 2))
+    run('similarity.pair', results, lambda: time_calls(lambda d1, d2: similarity(None, None, d1, d2), pairs))
+    run('similarity.pair_bounded', results, lambda: time_calls(lambda d1, d2: bounded_similarity(d1, d2, 0.6), pairs))
+
+    def all_pairs():
+        start = time.perf_counter()
+        similarity_matrix(features)
+        return [time.perf_counter() - start]
+    run('similarity.all_pairs', results, all_pairs)
+    if 'similarity.all_pairs' in results:
+        results['similarity.all_pairs']['pairs_per_second'] = len(features) ** 2 / results['similarity.all_pairs']['median']
+
+    def topk():
+        start = time.perf_counter()
+        build_topk_index_from_features(features, k=10)
+        return [time.perf_counter() - start]
+    run('similarity.topk_two_stage', results, topk)
+
+    #re-weighting stored components against scoring every pair again under the new weights
+    from component_store import apply_weights
+    from similarity_matrix import pack_features, component_block
+    everything = np.arange(len(features))
+    layers = component_block(pack_features(features), everything, everything)
+    profile = {'composer': 1, 'intervals': 3}
+    run('similarity.reweight', results, lambda: time_calls(lambda: apply_weights(layers, profile), [()]))
+
+
+def bench_recommendation(results, matrix, steps=2000):
+    from preferences import apply_feedback
+    from topk_index import build_topk_index, SparsePreferences
+
+    rng = np.random.default_rng(0)
+    songs = rng.integers(len(matrix), size=steps)
+    liked = rng.random(steps) < 0.5
+
+    neighbours, scores = build_topk_index(matrix)
+    prefs = SparsePreferences(len(matrix), matrix)
+    def sparse_step(curr, like):
+        prefs.update(neighbours, scores, curr, like)
+        prefs.top(3)
+    run('recommend.step_topk', results, lambda: time_calls(sparse_step, zip(songs, liked)))
+
+    dense = np.zeros((1, len(matrix)))
+    def dense_step(curr, like):
+        apply_feedback(dense, [0], [curr], [like], matrix)
+        np.argsort(-dense[0])[:3]
+    run('recommend.step_dense', results, lambda: time_calls(dense_step, zip(songs, liked)))
+
+
+"""
+Time from launching interactive.py until it is ready to play, with a precomputed store for the subset
+"""
+def bench_startup(results, names, matrix, repeats=5):
+    from similarity_store import write_similarity_store
+
+    with tempfile.TemporaryDirectory() as work:
+        write_similarity_store(os.path.join(work, 'all_pairs_similarity.sim'), names, matrix)
+        for corpus in ('essen', 'piano'):
+            os.symlink(REPO_DIR / corpus, os.path.join(work, corpus))
+        env = dict(os.environ, PYTHONPATH=str(REPO_DIR))
+
+        def launch():
+            start = time.perf_counter()
+            proc = subprocess.Popen([sys.executable, str(REPO_DIR / 'interactive.py')], cwd=work, env=env,
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            output = b''
+            while b'loaded!' not in output:
+                chunk = proc.stdout.read1(1024)
+                if not chunk:
+                    raise RuntimeError('interactive.py exited before it finished loading')
+                output += chunk
+            elapsed = time.perf_counter() - start
+            proc.kill()
+            proc.wait()
+            return elapsed
+
+        launch() #the first launch also builds the top-k index and the catalogue snapshot
+        run('interactive.startup', results, lambda: [launch() for _ in range(repeats)])
+
+
+"""
+Runs one benchmark and records its summary, or the error if it failed
+"""
+def run(name, results, bench):
+    print('%-32s' % name, end='', flush=True)
+    try:
+        results[name] = summarize(bench())
+        print('median %.6fs' % results[name]['median'])
+    except Exception as e:
+        results[name] = {'error': '%s: %s' % (type(e).__name__, e)}
+        print('failed (%s)' % results[name]['error'])
+
+
+"""
+Compares results with a baseline run. Returns the names of benchmarks whose median got slower than tolerance allows,
+or that the baseline timed and this run did not
+"""
+def compare(results, baseline, tolerance=TOLERANCE):
+    regressions = []
+    for name, base in sorted(baseline.items()):
+        if 'median' in base and 'median' not in results.get(name, {}):
+            regressions.append(name)
+            print('%-32s %.6fs -> %s  MISSING' % (name, base['median'], results.get(name, {}).get('error', 'not run')))
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base or 'median' not in base or 'median' not in result:
+            continue
+        ratio = result['median'] / base['median'] if base['median'] > 0 else 1.0
+        result['baseline_median'] = base['median']
+        result['ratio'] = ratio
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-32s %.6fs -> %.6fs (x%.2f)%s' % (name, base['median'], result['median'], ratio, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks extraction, similarity scoring and recommendation')
+    parser.add_argument('-o', '--output', default='bench_results.json', help='where to write the results as JSON')
+    parser.add_argument('--baseline', default=None, help='results JSON from an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--num-essen', type=int, default=NUM_ESSEN)
+    parser.add_argument('--skip-startup', action='store_true', help='do not time interactive.py startup')
+    args = parser.parse_args()
+
+    sys.path.insert(0, str(REPO_DIR))
+    from music21 import converter
+    from functions import extract_features
+    from similarity_matrix import similarity_matrix
+
+    results = dict()
+    paths = benchmark_scores(args.num_essen)
+    scores = []
+    run('parse', results, lambda: time_calls(lambda p: scores.append(converter.parse(p)), [(p,) for p in paths]))
+
+    bench_extraction(results, scores, paths)
+    bench_score_reader(results, paths)
+    features, names, skipped = [], [], []
+    for score, path in zip(scores, paths):
+        try:
+            features.append(extract_features(score, path))
+            names.append(path.name)
+        except Exception as e:
+            skipped.append(path.name)
+            print('skipping %s (%s: %s)' % (path.name, type(e).__name__, e))
+    bench_similarity(results, features)
+
+    matrix = similarity_matrix(features)
+    bench_recommendation(results, matrix)
+    if not args.skip_startup:
+        bench_startup(results, names, matrix)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if args.skip_startup:
+            baseline.pop('interactive.startup', None)
+        regressions = compare(results, baseline, args.tolerance)
+    #a run with failed benchmarks or scores left out does not time what it says it does, so it must not pass
+    failed = sorted(name for name, result in results.items() if 'error' in result)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'meta': {
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'scores': [str(p.relative_to(REPO_DIR)) for p in paths],
+                'incomplete': bool(failed or skipped),
+            },
+            'results': results,
+            'failed': failed,
+            'skipped': skipped,
+            'regressions': regressions,
+        }, f, indent=2)
+    print('wrote %s' % args.output)
+    if failed or skipped:
+        print('incomplete run: %d benchmarks failed, %d scores skipped' % (len(failed), len(skipped)))
+    if regressions or failed or skipped:
+        sys.exit(1)
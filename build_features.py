@@ -0,0 +1,158 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import sys
+import time
+from multiprocessing import Pool
+from pathlib import Path
+
+import instrumentation
+
+STORE_DIR = 'feature_store'
+FEATURE_VERSION = 3 #bump whenever extract_features changes, so stale features are not reused
+SCORE_SUFFIXES = ('.krn', '.mxl')
+
+
+"""
+Hash of a file's contents, which is what features are stored under
+"""
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+
+"""
+Where the features for a given content hash live in the store
+"""
+def feature_path(store_dir, digest):
+    return Path(store_dir) / ('v%d' % FEATURE_VERSION) / digest[:2] / (digest + '.pickle')
+
+
+"""
+All score files under the given directories (or given directly), in a stable order
+"""
+def find_scores(dirs):
+    paths = []
+    for d in dirs:
+        if Path(d).is_file():
+            paths.append(Path(d))
+        else:
+            paths.extend(p for p in Path(d).rglob('*') if p.suffix in SCORE_SUFFIXES)
+    return sorted(paths)
+
+
+"""
+Parses one score and writes its features to the store. Runs in a worker process.
+Monophonic kern is read by score_reader, anything else is parsed with music21.
+The pickle is written to a temporary file first so a crash never leaves a partial entry behind
+"""
+def _extract(job):
+    path, digest, store_dir = job
+    from functions import extract_features, melody_features
+    from score_reader import read_melody
+    try:
+        with instrumentation.timed('parse.score_reader'):
+            melody = read_melody(path)
+        if melody is not None:
+            features = melody_features(melody, path)
+        else: #not monophonic kern, go through music21
+            from music21 import converter
+            with instrumentation.timed('parse.music21'):
+                score = converter.parse(path)
+            features = extract_features(score, path)
+        error = None
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+    if error is None:
+        out = feature_path(store_dir, digest)
+        out.parent.mkdir(parents=True, exist_ok=True)
+        tmp = out.with_suffix('.tmp%d' % os.getpid())
+        with open(tmp, 'wb') as handle:
+            pickle.dump(features, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, out)
+    metrics = None
+    if instrumentation.enabled: #hand this worker's metrics to the parent
+        metrics = instrumentation.METRICS.snapshot()
+        instrumentation.METRICS.reset()
+    return path, digest, error, metrics
+
+
+"""
+Extracts features for every score under dirs that is not in the store yet, using a pool of processes.
+Files already in the store (same contents) are skipped, so re-runs and runs after a crash only do what's left.
+Returns the index mapping each file path to its content hash
+"""
+def build_feature_store(dirs, store_dir=STORE_DIR, processes=None):
+    paths = find_scores(dirs)
+    index = {str(path): file_hash(path) for path in paths}
+
+    jobs = []
+    queued = set()
+    for path, digest in index.items():
+        if digest not in queued and not feature_path(store_dir, digest).exists():
+            queued.add(digest)
+            jobs.append((path, digest, store_dir))
+    print('%d scores, %d up to date, %d to extract' % (len(paths), len(paths) - len(jobs), len(jobs)))
+    if instrumentation.enabled:
+        instrumentation.METRICS.cache('feature_store', hits=len(paths) - len(jobs), misses=len(jobs))
+
+    failed = dict()
+    if jobs:
+        start = time.time()
+        with Pool(processes or os.cpu_count(), initializer=instrumentation.METRICS.reset) as pool: #workers start without what the parent recorded
+            for done, (path, digest, error, metrics) in enumerate(pool.imap_unordered(_extract, jobs, chunksize=4), 1):
+                if metrics is not None:
+                    instrumentation.METRICS.merge(metrics)
+                if error is not None:
+                    failed[path] = error
+                    print('failed to extract %s (%s)' % (path, error))
+                if done % 100 == 0 or done == len(jobs):
+                    rate = done / (time.time() - start)
+                    print('[%d/%d] %.1f scores/s, %ds left' % (done, len(jobs), rate, (len(jobs) - done) / rate))
+
+    index = {path: digest for path, digest in index.items() if path not in failed}
+    Path(store_dir).mkdir(parents=True, exist_ok=True)
+    with open(Path(store_dir) / 'index.json', 'w') as f:
+        json.dump({'version': FEATURE_VERSION, 'files': index}, f, indent=0)
+    return index
+
+
+"""
+The store's index, mapping each score's path to its content hash
+"""
+def load_feature_index(store_dir=STORE_DIR):
+    with open(Path(store_dir) / 'index.json') as f:
+        return json.load(f)['files']
+
+
+"""
+Loads the features of every file in the store's index.
+Returns the file paths and their feature records, in the same order
+"""
+def load_feature_store(store_dir=STORE_DIR):
+    index = load_feature_index(store_dir)
+    paths = sorted(index)
+    features = []
+    for path in paths:
+        with open(feature_path(store_dir, index[path]), 'rb') as handle:
+            features.append(pickle.load(handle))
+    return paths, features
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Extracts features for every score into the feature store')
+    parser.add_argument('dirs', nargs='*', default=['essen', 'piano'])
+    parser.add_argument('--store', default=STORE_DIR)
+    parser.add_argument('-j', '--processes', type=int, default=None, help='worker processes (default: all cores)')
+    args = parser.parse_args()
+
+    index = build_feature_store(args.dirs, args.store, args.processes)
+    print('%d scores in %s' % (len(index), args.store))
+    failed = len(find_scores(args.dirs)) - len(index)
+    if failed:
+        print('%d scores could not be extracted and are not in the store' % failed)
+        sys.exit(1)
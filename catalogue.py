@@ -0,0 +1,106 @@
+import argparse
+import os
+from pathlib import Path
+
+import numpy as np
+
+from topk_index import TOPK_INDEX, load_topk_index
+
+"""
+Catalogue snapshot: everything interactive.py needs to start recommending, in one uncompressed .npz.
+It holds the piece names, the score file of each piece, the top-k neighbours and scores and the path of the
+similarity store they came from, so startup neither walks the corpus nor reads any other file.
+The score files come from the feature store's index, which has the path of every piece the store was built from.
+The snapshot remembers the modification time and size of the top-k index it was made from and is rebuilt
+whenever that index changes, e.g. after update_corpus.py
+"""
+
+CATALOGUE = 'catalogue.npz'
+FEATURE_STORE = 'feature_store'
+CORPUS_DIRS = ('essen', 'piano') #searched for score files when there is no feature store
+SIMILARITY_STORE = 'all_pairs_similarity.sim'
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+
+class Catalogue(object):
+
+    def __init__(self, names: list, paths: list, neighbours, scores, store_path):
+        self.names = names
+        self.path_map = {name: path for name, path in zip(names, paths) if path}
+        self.name_map = {name: i for i, name in enumerate(names)}
+        self.neighbours = neighbours
+        self.scores = scores
+        self.store_path = store_path
+        self._similarity = None
+
+    """
+    The full similarity matrix, memory-mapped the first time it is asked for, or None if the store is not there
+    """
+    def similarity(self):
+        if self._similarity is None and Path(self.store_path).exists():
+            from similarity_store import load_similarity_store
+            names, self._similarity = load_similarity_store(self.store_path)
+            if list(names) != self.names:
+                raise ValueError('%s does not hold the songs of the top-k index, rebuild one of them' % self.store_path)
+        return self._similarity
+
+
+"""
+Where the score file of every piece is, by the name the similarity store uses for it: from the index of the
+feature store at feature_dir, or, without one, every score file found under corpus_dirs
+"""
+def score_paths(feature_dir=FEATURE_STORE, corpus_dirs=CORPUS_DIRS):
+    from build_features import find_scores, load_feature_index #only needed when the snapshot is rebuilt
+
+    if (Path(feature_dir) / 'index.json').exists():
+        paths = sorted(load_feature_index(feature_dir))
+    else:
+        paths = [str(path) for path in find_scores(d for d in corpus_dirs if Path(d).exists())]
+    return {Path(path).name: path for path in paths}
+
+
+"""
+Snapshots the top-k index at topk_path, with the score file of every piece (see score_paths).
+Pieces without one are stored with an empty path
+"""
+def build_catalogue(path=CATALOGUE, topk_path=TOPK_INDEX, feature_dir=FEATURE_STORE, store_path=SIMILARITY_STORE, corpus_dirs=CORPUS_DIRS):
+    names, neighbours, scores = load_topk_index(topk_path)
+    found = score_paths(feature_dir, corpus_dirs)
+    paths = [found.get(name, '') if name else '' for name in names]
+    tmp = Path(str(path) + '.tmp%d' % os.getpid())
+    with open(tmp, 'wb') as f: #a file object, so numpy does not append .npz to the temporary name
+        np.savez(f, names=np.array(names), paths=np.array(paths), neighbours=neighbours, scores=scores,
+                 store=np.array(str(store_path)), topk=np.array(str(topk_path)), topk_stamp=_stamp(topk_path))
+    os.replace(tmp, path)
+    return Catalogue(names, paths, neighbours, scores, str(store_path))
+
+
+"""
+Loads a catalogue snapshot, or returns None if there is none or the top-k index it was made from has changed since
+"""
+def load_catalogue(path=CATALOGUE):
+    if not Path(path).exists():
+        return None
+    with np.load(path) as snapshot:
+        topk = str(snapshot['topk'])
+        if Path(topk).exists() and not np.array_equal(_stamp(topk), snapshot['topk_stamp']):
+            return None
+        return Catalogue(snapshot['names'].tolist(), snapshot['paths'].tolist(), snapshot['neighbours'],
+                         snapshot['scores'], str(snapshot['store']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Builds the catalogue snapshot interactive.py starts from')
+    parser.add_argument('--topk', default=TOPK_INDEX, help='top-k index to snapshot')
+    parser.add_argument('--features', default=FEATURE_STORE, help='feature store whose index has the score files')
+    parser.add_argument('--corpus', nargs='*', default=CORPUS_DIRS, help='directories to find the score files in when there is no feature store')
+    parser.add_argument('--store', default=SIMILARITY_STORE, help='similarity store the top-k index was built from')
+    parser.add_argument('-o', '--output', default=CATALOGUE)
+    args = parser.parse_args()
+
+    catalogue = build_catalogue(args.output, args.topk, args.features, args.store, args.corpus)
+    print('wrote %d pieces (%d with a score file) to %s' % (len(catalogue.names), len(catalogue.path_map), args.output))
@@ -0,0 +1,107 @@
+import argparse
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+
+from functions import SIMILARITY_COMPONENTS, weight_list
+
+"""
+Every pair's similarity components, scored once so a new weight profile costs one weighted sum instead of
+scoring the corpus again. The store is a (components + 1) x n x n array in .npy format, memory-mapped when loaded:
+one layer per component in the order of SIMILARITY_COMPONENTS, unweighted (the melodic arch as the sum of its terms),
+and the number of melodic arch terms last. With weights w, a pair scores
+    (w . layers[:-1]) / (sum of w except the arch + w_arch * layers[-1])
+which is similarity() with those weights up to the rounding of the stored layers.
+The piece names are kept next to the array, in <store>.names.json
+"""
+
+COMPONENT_STORE = 'all_pairs_similarity.components.npy'
+
+
+def names_path(path):
+    return Path(str(path) + '.names.json')
+
+
+"""
+Scores the components of every pair of pieces into a new store at path, in blocks of block_size x block_size
+on or above the diagonal and mirrored below it
+"""
+def build_component_store(path, names: list, features: list, block_size=256, dtype=np.float32):
+    from similarity_matrix import pack_features, component_block
+
+    packed = pack_features(features)
+    n = len(features)
+    layers = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(len(SIMILARITY_COMPONENTS) + 1, n, n))
+    for start in range(0, n, block_size):
+        rows = slice(start, min(start + block_size, n))
+        for col_start in range(start, n, block_size):
+            cols = slice(col_start, min(col_start + block_size, n))
+            block = component_block(packed, np.arange(rows.start, rows.stop), np.arange(cols.start, cols.stop))
+            layers[:, rows, cols] = block
+            layers[:, cols, rows] = block.transpose(0, 2, 1)
+    layers.flush()
+    with open(names_path(path), 'w') as f:
+        json.dump(list(names), f, indent=0)
+    return layers
+
+
+"""
+Returns the piece names and the memory-mapped component layers
+"""
+def load_component_store(path=COMPONENT_STORE):
+    with open(names_path(path)) as f:
+        names = json.load(f)
+    return names, np.load(path, mmap_mode='r')
+
+
+"""
+The (n x n) similarity matrix for a weight profile, as one weighted sum over the component layers.
+block_size rows are read at a time so the layers never have to be in memory at once. Pass out to fill an
+existing array, e.g. a similarity store from similarity_store.create_similarity_store
+"""
+def apply_weights(layers, weights=None, out=None, block_size=1024):
+    weights = np.array(weight_list(weights), dtype=np.float64)
+    base_max, arch_weight = weights[:-1].sum(), weights[-1]
+    n = layers.shape[1]
+    if out is None:
+        out = np.empty((n, n), dtype=np.float32)
+    for start in range(0, n, block_size):
+        rows = slice(start, min(start + block_size, n))
+        block = np.asarray(layers[:, rows], dtype=np.float64)
+        out[rows] = np.tensordot(weights, block[:-1], axes=1) / (base_max + arch_weight * block[-1])
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Scores every pair\'s similarity components once, then re-weights them into similarity stores')
+    parser.add_argument('command', choices=['build', 'apply'], help='score the components from the feature store, or apply a weight profile to them')
+    parser.add_argument('--components', default=COMPONENT_STORE)
+    parser.add_argument('--store', default='feature_store', help='feature store to build from')
+    parser.add_argument('--weights', default=None, help='JSON weight profile, {component: weight}; components it leaves out keep their default weight')
+    parser.add_argument('-o', '--output', default='all_pairs_similarity.sim', help='similarity store to write the re-weighted scores to')
+    parser.add_argument('--topk', default=None, help='also write the top-k index of the re-weighted scores here')
+    parser.add_argument('--float16', action='store_true', help='keep the components as float16 instead of float32')
+    args = parser.parse_args()
+
+    start = time.time()
+    if args.command == 'build':
+        from build_features import load_feature_store
+        paths, features = load_feature_store(args.store)
+        build_component_store(args.components, [Path(path).name for path in paths], features,
+                              dtype=np.float16 if args.float16 else np.float32)
+        print('scored the components of %d pieces into %s in %.1fs' % (len(paths), args.components, time.time() - start))
+    else:
+        from functions import load_weights
+        from similarity_store import create_similarity_store
+        names, layers = load_component_store(args.components)
+        weights = load_weights(args.weights) if args.weights else None
+        out = create_similarity_store(args.output, names, weights=weight_list(weights))
+        apply_weights(layers, weights, out)
+        out.flush()
+        print('wrote %s in %.1fs' % (args.output, time.time() - start))
+        if args.topk:
+            from topk_index import build_topk_index, save_topk_index
+            save_topk_index(args.topk, names, *build_topk_index(out))
+            print('wrote %s' % args.topk)
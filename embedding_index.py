@@ -0,0 +1,169 @@
+import argparse
+
+import numpy as np
+
+from topk_index import topk_entries
+
+EMBEDDINGS = 'song_embeddings.npz'
+
+
+"""
+Rows scaled to unit length, so dot products are cosine similarities
+"""
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+"""
+Spherical k-means: centroids are unit vectors and points go to the centroid with the highest cosine.
+Returns the centroids and each point's list
+"""
+def spherical_kmeans(vectors, num_lists, iterations=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), num_lists, replace=False)]
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        empty = ~sums.any(axis=1)
+        sums[empty] = vectors[rng.choice(len(vectors), empty.sum(), replace=False)] #restart empty lists
+        centroids = normalize(sums)
+    return centroids, np.argmax(vectors @ centroids.T, axis=1)
+
+
+"""
+Cosine nearest-neighbour index over song embeddings.
+Vectors are centred on the mean of the corpus first, since encoder states share a large common component.
+With num_lists == 0 every query is scored against every song in one matrix product.
+Otherwise songs are split into num_lists lists by spherical k-means (an IVF index) and a query is only
+scored against the songs in the nprobe lists whose centroids are closest to it
+"""
+class EmbeddingIndex(object):
+
+    def __init__(self, names, vectors, num_lists=None, nprobe=8, seed=0, mean=None):
+        self.names = [str(name) for name in names]
+        self.name_map = {name: i for i, name in enumerate(self.names)}
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.mean = vectors.mean(axis=0) if mean is None else np.asarray(mean, dtype=np.float32)
+        self.vectors = normalize(vectors - self.mean)
+        self.nprobe = nprobe
+        if num_lists is None:
+            num_lists = int(np.sqrt(len(self.names))) if len(self.names) >= 1024 else 0
+        self.centroids, self.assignment = None, None
+        if num_lists:
+            self.centroids, self.assignment = spherical_kmeans(self.vectors, min(num_lists, len(self.names)), seed=seed)
+        self._build_lists()
+
+    def _build_lists(self):
+        if self.centroids is None:
+            return
+        self.order = np.argsort(self.assignment, kind='stable')
+        self.list_offsets = np.searchsorted(self.assignment[self.order], np.arange(len(self.centroids) + 1))
+
+    def __len__(self):
+        return len(self.names)
+
+    """
+    Adds a song, e.g. one just run through the encoder, to its nearest list without retraining the lists
+    """
+    def add(self, name, vector):
+        vector = self.embed(vector)
+        if name in self.name_map:
+            self.vectors[self.name_map[name]] = vector
+        else:
+            self.name_map[name] = len(self.names)
+            self.names.append(name)
+            self.vectors = np.vstack([self.vectors, vector[None]])
+            if self.centroids is not None:
+                self.assignment = np.append(self.assignment, -1)
+        if self.centroids is not None:
+            self.assignment[self.name_map[name]] = np.argmax(self.centroids @ vector)
+            self._build_lists()
+
+    """
+    The k songs most similar to each query, best first, as (queries x k) index and score arrays.
+    Queries are vectors already centred and normalized like self.vectors, e.g. rows of it;
+    embed() turns encoder output into one. Songs at exclude[i] are never returned for query i
+    """
+    def search(self, queries, k=10, exclude=None):
+        queries = np.atleast_2d(queries)
+        k = min(k, len(self.names))
+        neighbours = np.zeros((len(queries), k), dtype=np.int32)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        if self.centroids is None:
+            candidates = [np.arange(len(self.names))] * len(queries)
+            all_scores = queries @ self.vectors.T
+            candidate_scores = list(all_scores)
+        else:
+            probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :self.nprobe]
+            candidates = [np.concatenate([self.order[self.list_offsets[l]:self.list_offsets[l + 1]] for l in probe]) for probe in probes]
+            candidate_scores = [self.vectors[c] @ q for c, q in zip(candidates, queries)]
+        for i, (c, s) in enumerate(zip(candidates, candidate_scores)):
+            if exclude is not None:
+                s = np.where(c == exclude[i], -np.inf, s)
+            top, top_scores = topk_entries(s, k)
+            neighbours[i, :len(top)], scores[i, :len(top)] = c[top], top_scores
+        return neighbours, scores
+
+    """
+    The k songs most similar to a song already in the index, itself excluded
+    """
+    def similar(self, name, k=10):
+        i = self.name_map[name]
+        neighbours, scores = self.search(self.vectors[i], k, exclude=[i])
+        return [(self.names[n], float(s)) for n, s in zip(neighbours[0], scores[0]) if np.isfinite(s)]
+
+    """
+    Neighbours of every song, in the format of topk_index, so the recommenders can run on embeddings
+    """
+    def topk_index(self, k=50, block_size=1024):
+        k = min(k, len(self.names) - 1)
+        neighbours = np.empty((len(self.names), k), dtype=np.int32)
+        scores = np.empty((len(self.names), k), dtype=np.float32)
+        for start in range(0, len(self.names), block_size):
+            rows = np.arange(start, min(start + block_size, len(self.names)))
+            neighbours[rows], scores[rows] = self.search(self.vectors[rows], k, exclude=rows)
+        return neighbours, scores
+
+    """
+    An encoder output as a query vector
+    """
+    def embed(self, vector):
+        return normalize(np.asarray(vector, dtype=np.float32) - self.mean)
+
+    def save(self, path):
+        arrays = dict(names=np.array(self.names), vectors=self.vectors, mean=self.mean, nprobe=self.nprobe)
+        if self.centroids is not None:
+            arrays.update(centroids=self.centroids, assignment=self.assignment)
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            index = cls(saved['names'], saved['vectors'], num_lists=0, nprobe=int(saved['nprobe']), mean=np.zeros(saved['vectors'].shape[1]))
+            index.mean = saved['mean']
+            if 'centroids' in saved:
+                index.centroids, index.assignment = saved['centroids'], saved['assignment']
+                index._build_lists()
+        return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Finds the songs closest to a song in embedding space')
+    parser.add_argument('song', nargs='?', help='song to find neighbours of')
+    parser.add_argument('--embeddings', default=EMBEDDINGS)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--topk', default=None, help='write a top-k index of every song\'s neighbours here, for interactive.py')
+    args = parser.parse_args()
+
+    index = EmbeddingIndex.load(args.embeddings)
+    if args.song:
+        for rank, (name, score) in enumerate(index.similar(args.song, args.k), 1):
+            print('%d. %s (%.3f)' % (rank, name, score))
+    if args.topk:
+        from topk_index import save_topk_index
+        neighbours, scores = index.topk_index()
+        save_topk_index(args.topk, index.names, neighbours, scores)
+        print('wrote %d neighbours for each of %d songs to %s' % (neighbours.shape[1], len(index), args.topk))
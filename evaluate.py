@@ -0,0 +1,295 @@
+import argparse
+import json
+import resource
+import time
+from pathlib import Path
+
+import numpy as np
+
+from similarity_store import TOMBSTONE
+from topk_index import topk_entries
+
+"""
+Headless evaluation of the recommender: replays many listening sessions against the same preference update
+interactive.py runs, for any similarity backend, and reports throughput, per-step latency, memory and how
+often the recommendations are songs the listener likes.
+Sessions are either simulated, by listeners who like the songs of a few collections of the corpus
+(the folder a song's file is in, e.g. han or mexico) and choose among the recommendations like a user would,
+or scripted, replayed from a log of feedback with each user's last likes held out
+"""
+
+EVALUATION = 'evaluation.json'
+CORPUS_DIR = 'essen'
+K = 3 #recommendations per step, as in interactive.py
+
+
+"""
+Recommends from full similarity rows, as interactive.py did with the whole matrix in memory:
+halve the preferences, add (or subtract) the song's row and rule the song out.
+similarity[i] is song i's row, from a memory-mapped similarity store or anything else that can produce one
+"""
+class DenseBackend(object):
+
+    def __init__(self, names, similarity):
+        self.names = list(names)
+        self.similarity = similarity
+        self.removed = [i for i, name in enumerate(self.names) if name == TOMBSTONE]
+
+    def start(self):
+        prefs = np.zeros(len(self.names))
+        prefs[self.removed] = -np.inf
+        return prefs
+
+    def update(self, prefs, song, liked):
+        prefs /= 2
+        prefs += np.nan_to_num(np.asarray(self.similarity[song], dtype=np.float64)) * (1 if liked else -1)
+        prefs[song] = -np.inf
+        return prefs
+
+    def top(self, prefs, k=K):
+        return topk_entries(prefs, k)[0]
+
+    def nbytes(self):
+        return self.similarity.nbytes
+
+
+"""
+Recommends from a top-k index with SparsePreferences, as interactive.py does now.
+similarity, e.g. the similarity store the index was built from, gives the full rows dislikes need
+"""
+class TopKBackend(object):
+
+    def __init__(self, names, neighbours, scores, similarity=None):
+        self.names = list(names)
+        self.neighbours = neighbours
+        self.scores = scores
+        self.similarity = similarity
+        self.removed = [i for i, name in enumerate(self.names) if name == TOMBSTONE]
+
+    def start(self):
+        from topk_index import SparsePreferences
+        prefs = SparsePreferences(len(self.names), self.similarity)
+        prefs.exclude(self.removed)
+        return prefs
+
+    def update(self, prefs, song, liked):
+        prefs.update(self.neighbours, self.scores, song, liked)
+        return prefs
+
+    def top(self, prefs, k=K):
+        return prefs.top(k)
+
+    def nbytes(self):
+        return self.neighbours.nbytes + self.scores.nbytes + (self.similarity.nbytes if self.similarity is not None else 0)
+
+
+"""
+Cosine similarity rows computed from an EmbeddingIndex when asked for, so DenseBackend can recommend from
+embeddings without an n x n matrix
+"""
+class CosineRows(object):
+
+    def __init__(self, index):
+        self.vectors = index.vectors
+
+    def __getitem__(self, song):
+        return self.vectors @ self.vectors[song]
+
+    @property
+    def nbytes(self):
+        return self.vectors.nbytes
+
+
+"""
+The similarity store at path, converting an old all-pairs CSV once into a store next to it
+"""
+def load_store(path):
+    from similarity_store import load_similarity_store, convert_csv
+    if Path(path).suffix == '.csv':
+        store = Path(path).with_suffix('.sim')
+        if not store.exists():
+            convert_csv(path, store)
+        path = store
+    return load_similarity_store(path)
+
+
+"""
+A backend of the given kind from path. A top-k backend takes the rows for dislikes from the similarity store at store
+"""
+def load_backend(kind, path, store=None):
+    if kind == 'dense':
+        return DenseBackend(*load_store(path))
+    if kind == 'topk':
+        from topk_index import load_topk_index
+        names, neighbours, scores = load_topk_index(path)
+        similarity = None
+        if store is not None:
+            store_names, similarity = load_store(store)
+            if list(store_names) != list(names):
+                raise ValueError('%s and %s do not hold the same songs' % (store, path))
+        return TopKBackend(names, neighbours, scores, similarity)
+    if kind == 'embedding':
+        from embedding_index import EmbeddingIndex
+        index = EmbeddingIndex.load(path)
+        return DenseBackend(index.names, CosineRows(index))
+    raise ValueError('unknown backend %s' % kind)
+
+
+"""
+The collection of every song, as an index into the sorted collection names (-1 for songs without a file under
+corpus_dir), and those names
+"""
+def song_collections(names: list, corpus_dir=CORPUS_DIR):
+    folders = {path.name: path.parent.name for path in Path(corpus_dir).rglob('*.krn')}
+    collections = sorted(set(folders[name] for name in names if name in folders))
+    collection_map = {collection: i for i, collection in enumerate(collections)}
+    return np.array([collection_map[folders[name]] if name in folders else -1 for name in names]), collections
+
+
+"""
+Latency percentiles, in seconds, of a list of timings
+"""
+def latency_summary(timings):
+    timings = np.asarray(timings)
+    return {
+        'p50': float(np.percentile(timings, 50)),
+        'p90': float(np.percentile(timings, 90)),
+        'p99': float(np.percentile(timings, 99)),
+        'max': float(timings.max()),
+    }
+
+
+"""
+Runs sessions simulated listening sessions of steps songs each. Every listener likes the songs of favourites
+collections, picked at random among those with more than steps + k songs, and answers the other way with
+probability noise. After each answer the listener takes the first of the k recommendations from a favourite
+collection, or the first one if there is none.
+A step is a hit if any of its k recommendations is from a favourite collection and not played yet;
+precision is the fraction of such recommendations and base_rate what recommending at random would give
+"""
+def simulate_sessions(backend, collections, sessions=1000, steps=20, k=K, favourites=1, noise=0.1, seed=0):
+    rng = np.random.default_rng(seed)
+    live = np.flatnonzero((collections >= 0) & np.array([name != TOMBSTONE for name in backend.names]))
+    sizes = np.bincount(collections[live])
+    eligible = np.flatnonzero(sizes > steps + k)
+    if len(eligible) < favourites:
+        raise ValueError('fewer than %d collections have more than %d songs' % (favourites, steps + k))
+    timings = []
+    hits, precision, base_rate, liked = 0, 0.0, 0.0, 0
+    start = time.perf_counter()
+    for _ in range(sessions):
+        favourite = np.isin(collections, rng.choice(eligible, favourites, replace=False))
+        unplayed = np.zeros(len(collections), dtype=bool)
+        unplayed[live] = True
+        prefs = backend.start()
+        curr = rng.choice(live)
+        for _ in range(steps):
+            unplayed[curr] = False
+            answer = favourite[curr] != (rng.random() < noise)
+            liked += answer
+            step_start = time.perf_counter()
+            prefs = backend.update(prefs, curr, answer)
+            top = backend.top(prefs, k)
+            timings.append(time.perf_counter() - step_start)
+            good = favourite[top] & unplayed[top]
+            hits += good.any()
+            precision += good.mean()
+            base_rate += (favourite & unplayed).sum() / unplayed.sum()
+            curr = top[np.argmax(good)]
+    elapsed = time.perf_counter() - start
+    num_steps = sessions * steps
+    return {
+        'sessions': sessions,
+        'steps': num_steps,
+        'sessions_per_s': sessions / elapsed,
+        'steps_per_s': num_steps / elapsed,
+        'latency': latency_summary(timings),
+        'hit_rate': hits / num_steps,
+        'precision': precision / num_steps,
+        'base_rate': base_rate / num_steps,
+        'like_rate': liked / num_steps,
+    }
+
+
+"""
+Replays a feedback log (user, song, liked columns, in the order the feedback was given) one user at a time,
+holding out each user's last holdout likes. Returns the fraction of users with a held-out like among their top k
+"""
+def replay_log(backend, log, k=10, holdout=1):
+    name_map = {name: i for i, name in enumerate(backend.names)}
+    sessions = dict()
+    for user, song, answer in zip(log['user'], log['song'], log['liked']):
+        if song in name_map:
+            sessions.setdefault(user, []).append((name_map[song], bool(answer)))
+    hits, users = 0, 0
+    for events in sessions.values():
+        likes = [i for i, (_, answer) in enumerate(events) if answer]
+        if len(likes) <= holdout:
+            continue
+        held_out = likes[-holdout:]
+        prefs = backend.start()
+        for i, (song, answer) in enumerate(events):
+            if i not in held_out:
+                prefs = backend.update(prefs, song, answer)
+        hits += bool(np.isin([events[i][0] for i in held_out], backend.top(prefs, k)).any())
+        users += 1
+    return {'users': users, 'hit_rate': hits / users if users else None, 'k': k, 'holdout': holdout}
+
+
+"""
+Bytes of the backend's data, of one session's state and the peak resident size of this process so far
+"""
+def memory_use(backend):
+    session = backend.start()
+    return {
+        'backend_bytes': int(backend.nbytes()),
+        'session_bytes': int(getattr(session, 'prefs', session).nbytes), #SparsePreferences keeps its values in prefs
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replays simulated or scripted listening sessions against similarity backends')
+    parser.add_argument('--dense', default=None, help='similarity store (or all-pairs CSV) to recommend from full rows of')
+    parser.add_argument('--topk', default=None, help='top-k index to recommend from')
+    parser.add_argument('--embeddings', default=None, help='song embeddings to recommend from cosine similarities of')
+    parser.add_argument('--store', default=None, help='similarity store the top-k backend takes dislikes from (default: the --dense one)')
+    parser.add_argument('--corpus', default=CORPUS_DIR, help='directory whose folders are the simulated listeners\' collections')
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--steps', type=int, default=20, help='songs per simulated session')
+    parser.add_argument('-k', type=int, default=K)
+    parser.add_argument('--favourites', type=int, default=1, help='collections each simulated listener likes')
+    parser.add_argument('--noise', type=float, default=0.1, help='probability of a simulated answer being the other way')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--log', default=None, help='CSV of user,song,liked feedback to replay with held-out likes instead of simulating')
+    parser.add_argument('--holdout', type=int, default=1, help='likes held out per user of the log')
+    parser.add_argument('-o', '--output', default=EVALUATION)
+    args = parser.parse_args()
+
+    backends = [(kind, path) for kind, path in (('dense', args.dense), ('topk', args.topk), ('embedding', args.embeddings)) if path]
+    if not backends:
+        parser.error('give at least one of --dense, --topk and --embeddings')
+    log = None
+    if args.log:
+        import pandas as pd
+        log = pd.read_csv(args.log)
+
+    results = dict()
+    for kind, path in backends:
+        backend = load_backend(kind, path, args.store or args.dense)
+        if log is not None:
+            result = replay_log(backend, log, args.k, args.holdout)
+            print('%-10s %d users, hit rate@%d %.3f' % (kind, result['users'], args.k, result['hit_rate'] or 0))
+        else:
+            collections, _ = song_collections(backend.names, args.corpus)
+            result = simulate_sessions(backend, collections, args.sessions, args.steps, args.k, args.favourites, args.noise, args.seed)
+            print('%-10s %7.1f sessions/s  step p50 %6.1fus p99 %6.1fus  hit rate@%d %.3f  precision %.3f (random %.3f)' % (
+                kind, result['sessions_per_s'], result['latency']['p50'] * 1e6, result['latency']['p99'] * 1e6,
+                args.k, result['hit_rate'], result['precision'], result['base_rate']))
+        result['memory'] = memory_use(backend)
+        result['source'] = str(path)
+        results[kind] = result
+
+    with open(args.output, 'w') as f:
+        json.dump({'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'args': vars(args)}, 'results': results}, f, indent=2)
+    print('wrote %s' % args.output)
@@ -0,0 +1,245 @@
+import argparse
+
+import numpy as np
+
+"""
+Index of melodic fingerprints, for finding variants of a tune without scanning the whole corpus.
+Every song's interval shingles (functions.interval_shingles) get a MinHash signature of NUM_HASHES hashes;
+the fraction of hashes on which two signatures agree estimates the Jaccard similarity of their shingle sets.
+Signatures are cut into BANDS bands (locality-sensitive hashing), and the band keys of every song are kept
+sorted, so the songs sharing a band with a query are found by binary search instead of comparing with each song.
+With r = NUM_HASHES / BANDS hashes per band, two songs whose shingle sets have Jaccard similarity s share a band
+with probability 1 - (1 - s^r)^BANDS: about 0.23 at s = 0.2, 0.58 at s = 0.3 and 0.99 at s = 0.5
+"""
+
+FINGERPRINTS = 'melodic_fingerprints.npz'
+NUM_HASHES = 96
+BANDS = 32 #LSH bands of NUM_HASHES // BANDS hashes each
+EMPTY = 0xFFFFFFFF #every hash of a melody without shingles; such songs are never candidates
+BAND_MULTIPLIER = np.uint64(0x100000001B3) #combines the hashes of a band into one key
+
+
+"""
+Parameters of the multiply-shift hash functions: hash i of x is the top 32 bits of a[i] * x + b[i] modulo 2^64
+"""
+def hash_functions(num_hashes=NUM_HASHES, seed=0):
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, 2**64, num_hashes, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2**64, num_hashes, dtype=np.uint64)
+    return a, b
+
+
+"""
+MinHash signatures of sets of shingles, as a (sets x hashes) uint32 array.
+The sets are hashed block_size at a time, all shingles of a block in one array operation
+"""
+def minhash_signatures(shingle_sets: list, a, b, block_size=1024):
+    signatures = np.full((len(shingle_sets), len(a)), EMPTY, dtype=np.uint32)
+    for start in range(0, len(shingle_sets), block_size):
+        sets = [s if s is not None else () for s in shingle_sets[start:start + block_size]]
+        lengths = np.array([len(s) for s in sets])
+        filled = np.flatnonzero(lengths)
+        if len(filled) == 0:
+            continue
+        shingles = np.concatenate([sets[i] for i in filled]).astype(np.uint64)
+        hashes = ((shingles[:, None] * a + b) >> np.uint64(32)).astype(np.uint32)
+        offsets = np.concatenate([[0], np.cumsum(lengths[filled])[:-1]])
+        signatures[start + filled] = np.minimum.reduceat(hashes, offsets, axis=0)
+    return signatures
+
+
+"""
+One key per band for each signature, as a (signatures x bands) array
+"""
+def band_keys(signatures, bands=BANDS):
+    rows = signatures.shape[1] // bands
+    banded = signatures[:, :bands * rows].reshape(len(signatures), bands, rows).astype(np.uint64)
+    keys = np.zeros((len(signatures), bands), dtype=np.uint64)
+    for j in range(rows):
+        keys = (keys * BAND_MULTIPLIER) ^ banded[:, :, j]
+    return keys
+
+
+"""
+The k highest-scoring songs for each query from (query, song, score) triples, as (queries x k) neighbour and
+score arrays sorted best first. Queries with fewer than k songs are padded with -inf, like topk_index does
+"""
+def _top_per_query(queries, songs, scores, num_queries, k):
+    order = np.lexsort((-scores, queries))
+    queries, songs, scores = queries[order], songs[order], scores[order]
+    rank = np.arange(len(queries)) - np.searchsorted(queries, np.arange(num_queries))[queries]
+    keep = rank < k
+    neighbours = np.zeros((num_queries, k), dtype=np.int32)
+    top_scores = np.full((num_queries, k), -np.inf, dtype=np.float32)
+    neighbours[queries[keep], rank[keep]] = songs[keep]
+    top_scores[queries[keep], rank[keep]] = scores[keep]
+    return neighbours, top_scores
+
+
+class FingerprintIndex(object):
+
+    def __init__(self, names, signatures, bands=BANDS, seed=0):
+        self.names = [str(name) for name in names]
+        self.name_map = {name: i for i, name in enumerate(self.names)}
+        self.signatures = np.asarray(signatures, dtype=np.uint32)
+        self.bands = bands
+        self.seed = seed
+        self.hash_a, self.hash_b = hash_functions(self.signatures.shape[1], seed)
+        self._build_buckets()
+
+    def _build_buckets(self):
+        filled = np.flatnonzero((self.signatures != EMPTY).any(axis=1))
+        keys = band_keys(self.signatures[filled], self.bands)
+        order = np.argsort(keys, axis=0, kind='stable')
+        self.bucket_keys = np.take_along_axis(keys, order, axis=0).T.copy() #bands x songs, sorted
+        self.bucket_songs = filled[order].T.copy()
+
+    """
+    Index of songs from their interval shingles, e.g. the shingles field of their features
+    """
+    @classmethod
+    def from_shingles(cls, names, shingle_sets: list, num_hashes=NUM_HASHES, bands=BANDS, seed=0):
+        a, b = hash_functions(num_hashes, seed)
+        return cls(names, minhash_signatures(shingle_sets, a, b), bands, seed)
+
+    def __len__(self):
+        return len(self.names)
+
+    def signature(self, shingles):
+        return minhash_signatures([shingles], self.hash_a, self.hash_b)[0]
+
+    """
+    Adds a song, or replaces the fingerprint of one already in the index
+    """
+    def add(self, name, shingles):
+        signature = self.signature(shingles)
+        if name in self.name_map:
+            self.signatures[self.name_map[name]] = signature
+        else:
+            self.name_map[name] = len(self.names)
+            self.names.append(name)
+            self.signatures = np.vstack([self.signatures, signature[None]])
+        self._build_buckets()
+
+    """
+    Every song that shares at least one band with a query signature, as (query, song) index arrays, each pair once
+    """
+    def candidate_pairs(self, signatures):
+        keys = band_keys(np.atleast_2d(signatures), self.bands)
+        queries, songs = [], []
+        for band in range(self.bands):
+            start = np.searchsorted(self.bucket_keys[band], keys[:, band], side='left')
+            sizes = np.searchsorted(self.bucket_keys[band], keys[:, band], side='right') - start
+            first = np.repeat(start - np.cumsum(sizes) + sizes, sizes) #position in the bucket = this + pair number
+            queries.append(np.repeat(np.arange(len(keys)), sizes))
+            songs.append(self.bucket_songs[band][first + np.arange(sizes.sum())])
+        pairs = np.unique(np.concatenate(queries).astype(np.int64) * len(self.names) + np.concatenate(songs))
+        return pairs // len(self.names), pairs % len(self.names)
+
+    """
+    The k songs with the most similar fingerprints to each query signature, best first, as (queries x k) index and
+    estimated Jaccard similarity arrays. Only candidates from the LSH buckets are compared, so songs sharing
+    no band with a query are never returned. Songs at exclude[i] are never returned for query i
+    """
+    def search(self, signatures, k=10, exclude=None):
+        signatures = np.atleast_2d(signatures)
+        queries, songs = self.candidate_pairs(signatures)
+        if exclude is not None:
+            keep = songs != np.asarray(exclude)[queries]
+            queries, songs = queries[keep], songs[keep]
+        estimates = (signatures[queries] == self.signatures[songs]).mean(axis=1)
+        return _top_per_query(queries, songs, estimates, len(signatures), min(k, len(self.names)))
+
+    """
+    The k songs whose melodies are most like a song already in the index, itself excluded
+    """
+    def similar(self, name, k=10):
+        i = self.name_map[name]
+        neighbours, scores = self.search(self.signatures[i], k, exclude=[i])
+        return [(self.names[n], float(s)) for n, s in zip(neighbours[0], scores[0]) if np.isfinite(s)]
+
+    """
+    The k best candidates of the songs at rows by the full similarity(), as (rows x k) neighbour and score arrays.
+    packed holds every song's features in the index's order (similarity_matrix.pack_features).
+    With max_candidates, only that many candidates with the best fingerprint estimates are scored per song
+    """
+    def rerank(self, packed, rows, k=10, max_candidates=None):
+        from similarity_matrix import pair_similarity
+
+        rows = np.atleast_1d(rows)
+        queries, songs = self.candidate_pairs(self.signatures[rows])
+        keep = songs != rows[queries]
+        queries, songs = queries[keep], songs[keep]
+        if max_candidates is not None:
+            estimates = (self.signatures[rows[queries]] == self.signatures[songs]).mean(axis=1)
+            best, best_estimates = _top_per_query(queries, songs, estimates, len(rows), max_candidates)
+            found = np.isfinite(best_estimates)
+            queries, songs = np.nonzero(found)[0], best[found]
+        scores = pair_similarity(packed, rows[queries], songs)
+        return _top_per_query(queries, songs, scores, len(rows), min(k, len(self.names) - 1))
+
+    """
+    Neighbours of every song among its candidates, reranked by similarity(), in the format of topk_index.
+    Songs with fewer than k candidates have their remaining neighbours padded with -inf
+    """
+    def topk_index(self, packed, k=50, max_candidates=None, block_size=1024):
+        k = min(k, len(self.names) - 1)
+        neighbours = np.empty((len(self.names), k), dtype=np.int32)
+        scores = np.empty((len(self.names), k), dtype=np.float32)
+        for start in range(0, len(self.names), block_size):
+            rows = np.arange(start, min(start + block_size, len(self.names)))
+            neighbours[rows], scores[rows] = self.rerank(packed, rows, k, max_candidates)
+        return neighbours, scores
+
+    def save(self, path):
+        np.savez(path, names=np.array(self.names), signatures=self.signatures, bands=self.bands, seed=self.seed)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            return cls(saved['names'], saved['signatures'], int(saved['bands']), int(saved['seed']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Finds melodic variants of a song through an index of interval fingerprints')
+    parser.add_argument('song', nargs='?', help='song to find variants of')
+    parser.add_argument('--fingerprints', default=FINGERPRINTS)
+    parser.add_argument('--build', action='store_true', help='(re)build the index from the feature store first')
+    parser.add_argument('--store', default='feature_store', help='feature store to build from and rerank with')
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--rerank', action='store_true', help='order the candidates by similarity() instead of their fingerprints')
+    parser.add_argument('--topk', default=None, help='write a top-k index of every song\'s reranked candidates here, for interactive.py')
+    args = parser.parse_args()
+
+    packed = None
+    if args.build or args.rerank or args.topk:
+        from pathlib import Path
+        from build_features import load_feature_store
+        from similarity_matrix import pack_features
+        paths, features = load_feature_store(args.store)
+        names = [Path(path).name for path in paths]
+        packed = pack_features(features)
+    if args.build:
+        index = FingerprintIndex.from_shingles(names, [f.shingles for f in features])
+        index.save(args.fingerprints)
+        print('wrote fingerprints of %d songs to %s' % (len(index), args.fingerprints))
+    else:
+        index = FingerprintIndex.load(args.fingerprints)
+        if packed is not None and names != index.names:
+            raise SystemExit('%s does not match %s, rebuild it with --build' % (args.fingerprints, args.store))
+
+    if args.song:
+        if args.rerank:
+            neighbours, scores = index.rerank(packed, index.name_map[args.song], args.k)
+            similar = [(index.names[n], float(s)) for n, s in zip(neighbours[0], scores[0]) if np.isfinite(s)]
+        else:
+            similar = index.similar(args.song, args.k)
+        for rank, (name, score) in enumerate(similar, 1):
+            print('%d. %s (%.3f)' % (rank, name, score))
+        if not similar:
+            print('no song shares a fingerprint band with %s' % args.song)
+    if args.topk:
+        from topk_index import save_topk_index
+        neighbours, scores = index.topk_index(packed)
+        save_topk_index(args.topk, index.names, neighbours, scores)
+        print('wrote up to %d neighbours for each of %d songs to %s' % (neighbours.shape[1], len(index), args.topk))
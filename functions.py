@@ -1,9 +1,17 @@
 from music21 import stream, corpus, note, pitch, converter, meter, key, expressions, scale, chord
+from music21.common import opFrac
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+import time
 import numpy as np
 
+import instrumentation
+
 """
 Average pitch height for phrases of variable length in a score
 """
+@instrumentation.instrumented('extract.melodic_arch')
 def melodic_arch(score: stream.Stream, phrase_length: int):
     total_phrases = 0 #total number of phrases
     sum_pitch_height = [0 for i in range(phrase_length)]  #sum of heights for each note position, measured in semitones above middle C
@@ -35,6 +43,7 @@ def melodic_arch(score: stream.Stream, phrase_length: int):
 """
 Returns average phrase length
 """
+@instrumentation.instrumented('extract.avg_phrase_length')
 def avg_phrase_length(score: stream.Stream):
     total_phrases = 0 #total number of phrases
     length = 0 #phrase is empty at beginning of piece
@@ -59,15 +68,95 @@ def avg_phrase_length(score: stream.Stream):
         return None
     return sum(phrase_lengths)/total_phrases
 
+"""
+Aarden-Essen key profiles, the weights music21's analyze('key') correlates pitch class histograms with
+"""
+MAJOR_KEY_WEIGHTS = (17.7661, 0.145624, 14.9265, 0.160186, 19.8049, 11.3587, 0.291248, 22.062, 0.145624, 8.15494, 0.232998, 4.95122)
+MINOR_KEY_WEIGHTS = (18.2648, 0.737619, 14.0499, 16.8599, 0.702494, 14.4362, 0.702494, 18.6161, 4.56621, 1.93186, 7.37619, 1.75623)
+MAJOR_STEPS = (0, 2, 4, 5, 7, 9, 11)
+MINOR_STEPS = (0, 2, 3, 5, 7, 8, 10) #natural minor, like music21's minor keys
+
+SHINGLE_LENGTH = 4 #successive intervals in each melodic shingle
+
+
+"""
+The key of a piece: its tonic's pitch class, its mode, the pitch classes in it and the tonal certainty music21 gives
+"""
+@dataclass(frozen=True)
+class KeyAnalysis:
+    tonic: int
+    mode: str
+    pitch_classes: frozenset
+    certainty: float
+
+
+"""
+Adds a note to a pitch class histogram: its duration for each of its pitch classes.
+Durations are added as music21 numbers (exact fractions for tuplets), in note order, the way analyze('key') adds them
+"""
+def add_to_histogram(histogram: list, pitch_classes, quarter_length):
+    quarter_length = opFrac(quarter_length)
+    for pc in pitch_classes:
+        histogram[pc] += quarter_length
+
+
+"""
+Correlation of a pitch class histogram with the key profile for each of the 12 tonics, worked out exactly as music21 does
+"""
+def _key_correlations(histogram, weights):
+    profile_average = sum(weights) / len(weights)
+    histogram_average = sum(histogram) / len(histogram)
+    correlations = []
+    for i in range(12):
+        top, bottom_right, bottom_left = 0.0, 0.0, 0.0
+        for j in range(12):
+            top = top + ((weights[(j - i) % 12] - profile_average) * (histogram[j] - histogram_average))
+            bottom_right = bottom_right + ((weights[(j - i) % 12] - profile_average) ** 2)
+            bottom_left = bottom_left + ((histogram[j] - histogram_average) ** 2)
+        correlations.append(0.0 if bottom_right == 0 or bottom_left == 0 else float(top / ((bottom_right * bottom_left) ** 0.5)))
+    return correlations
+
+
+"""
+Key of a pitch class histogram, the same as score.analyze('key') on the notes it was built from.
+The analysis only depends on the histogram, so it is worked out once for each histogram
+"""
+@lru_cache(maxsize=65536)
+@instrumentation.instrumented('extract.analyze_key') #only analyses that miss the cache are timed
+def analyze_key(histogram: tuple):
+    candidates = [(c, pc, 'major') for pc, c in enumerate(_key_correlations(histogram, MAJOR_KEY_WEIGHTS))]
+    candidates += [(c, pc, 'minor') for pc, c in enumerate(_key_correlations(histogram, MINOR_KEY_WEIGHTS))]
+    candidates.sort(reverse=True)
+    best, tonic, mode = candidates[0]
+
+    #tonalCertainty(): the best correlation plus twice its lead over the next best positive one
+    others = [c for c, _, _ in candidates[1:] if c > 0]
+    if not others:
+        certainty = best if best > 0 else 0.0
+    else:
+        certainty = (best * 1) + ((best - others[0]) * 2)
+    steps = MAJOR_STEPS if mode == 'major' else MINOR_STEPS
+    return KeyAnalysis(tonic, mode, frozenset((tonic + step) % 12 for step in steps), certainty)
+
+instrumentation.METRICS.register_cache('key_analysis', analyze_key.cache_info)
+
+
+"""
+Pitch class histogram of every note in a score, in the order analyze('key') reads them
+"""
+def score_histogram(score: stream.Stream):
+    histogram = [0] * 12
+    for n in score.flatten().notes:
+        add_to_histogram(histogram, [p.pitchClass for p in n.pitches], n.quarterLength)
+    return tuple(histogram)
+
+
 """
 Returns key with tonal certainty, and total percentage of notes within the key
 """
+@instrumentation.instrumented('extract.nonharmonic_notes')
 def nonharmonic_notes(score: stream.Stream):
-    key_sig = score.analyze('key')
-    certainty = key_sig.tonalCertainty()
-    notes_within_key = [p.name for p in key_sig.pitches]
-    for pitch in key_sig.pitches:
-        notes_within_key.extend([p.name for p in pitch.getAllCommonEnharmonics()])
+    key_sig = analyze_key(score_histogram(score))
     total_notes = 0 #total number of notes
     num_nonharmonic = 0 #total number of nonharmonic notes
     for n in score.recurse().notes:
@@ -76,14 +165,14 @@ def nonharmonic_notes(score: stream.Stream):
         if n.tie and (n.tie.type == 'stop' or n.tie.type == 'continue'): #do not count a tied note more than once
             continue
         else:
-            if n.pitch.name not in notes_within_key:
+            if n.pitch.pitchClass not in key_sig.pitch_classes:
                 num_nonharmonic += 1
             total_notes += 1
 
     if total_notes == 0:
         return None
 
-    return (certainty, 1-num_nonharmonic/total_notes)
+    return (key_sig.certainty, 1-num_nonharmonic/total_notes)
 
 
 
@@ -110,6 +199,7 @@ def get_key(score: stream.Stream):
 """
 Returns distribution of note lengths from increments of sixteenths up until a whole note
 """
+@instrumentation.instrumented('extract.get_note_lengths')
 def get_note_lengths(score: stream.Stream):
     note_lengths = dict()
     note_count = 0.0
@@ -135,9 +225,10 @@ def get_note_lengths(score: stream.Stream):
 """
 Computes distribution of intervals within one octave
 """
+@instrumentation.instrumented('extract.get_intervals')
 def get_intervals(score: stream.Stream):
     ints = np.zeros(25)
-    notes = score.flat.notes
+    notes = score.flatten().notes
     for n1, n2 in zip(notes[:-1], notes[1:]):
         if isinstance(n1, chord.Chord):
             n1 = max(n1)
@@ -157,7 +248,10 @@ Returns type of piece as a vector with a 1 in the index that matches type of pie
 [chorale, jig, ballad, bach, sonata, symphony, opus]
 """
 def piece_name(score: stream.Stream):
-    filename = score.filePath.name
+    file_path = getattr(score, 'filePath', None) or score.metadata.filePath #newer music21 keeps it in the metadata
+    return piece_name_from_filename(Path(file_path).name)
+
+def piece_name_from_filename(filename: str):
     is_chorale = int('chorale' in filename or 'Chorale' in filename)
     is_jig = int('jig' in filename or 'Jig' in filename)
     is_bach = int('bach' in filename or 'Bach' in filename or 'bwv' in filename)
@@ -169,6 +263,7 @@ def piece_name(score: stream.Stream):
 """
 Basic metadata features
 """
+@instrumentation.instrumented('extract.metadata_attributes')
 def metadata_attributes(score: stream.Stream):
     return score.metadata.all()
 
@@ -177,6 +272,7 @@ def metadata_attributes(score: stream.Stream):
 Basic musical features
 Returns [meter, key, num_parts, all_instruments]
 """
+@instrumentation.instrumented('extract.musical_attributes')
 def musical_attributes(score: stream.Stream):
     meter = get_meter(score) #gets the first meter of the score
     key = get_key(score) #gets the first key of the score
@@ -188,20 +284,283 @@ def musical_attributes(score: stream.Stream):
 
 
 """
-Computes similarity between two pieces based on musical attributes, ideally
+Every feature similarity() reads from a piece, including its melodic arch for every phrase length.
+Supports d['field'] lookups so it can be passed anywhere the old feature dicts were.
 """
-def similarity(s1: stream.Stream, s2: stream.Stream, d1=None, d2=None):
-    max_score, score = 0, 0
-    #comparing metadata
-    ma1 = d1['metadata'] if d1 else metadata_attributes(s1)
-    ma2 = d2['metadata'] if d2 else metadata_attributes(s2)
-    comp1, comp2 = None, None
-    for tup in ma1:
-        if tup[0] == 'composer':
-            comp1 = tup[1]
-    for tup in ma2:
+@dataclass
+class PieceFeatures:
+    metadata: tuple
+    musical_attr: list
+    note_lengths: list
+    phrase_lengths: float #average phrase length, keyed like the old feature dicts
+    name: tuple
+    nonharmonics: tuple
+    intervals: np.ndarray
+    arch_lengths: np.ndarray #sorted phrase lengths that occur in the piece
+    arch_profiles: np.ndarray #melodic arch for each of those lengths, concatenated in the same order
+    shingles: np.ndarray = None #interval n-grams of the melody, for fingerprint_index.py
+
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+
+"""
+Extracts all features of a piece in a single walk over the score
+"""
+@instrumentation.instrumented('extract.extract_features')
+def extract_features(score: stream.Stream, path=None):
+    first_meter, first_key = None, None
+    is_polyphonic = len(score.parts) > 1
+    note_lengths = dict()
+    note_count = 0.0
+    all_pitches = [] #every sounding note, tied or not, for the interval distribution
+    untied_pcs = [] #pitch classes of notes that are not tie continuations
+    untied_pitches = [] #and their pitches, for the melodic fingerprint
+    histogram = [0] * 12 #time spent on each pitch class, for the key
+    phrases = []
+    phrase = []
+    for n in score.recurse():
+        if isinstance(n, meter.TimeSignature):
+            if first_meter is None:
+                first_meter = n
+            continue
+        if isinstance(n, key.KeySignature):
+            if first_key is None:
+                first_key = n
+            continue
+        if isinstance(n, stream.Voice):
+            is_polyphonic = True
+            continue
+        if not isinstance(n, note.GeneralNote):
+            continue
+        if not n.isRest:
+            add_to_histogram(histogram, [p.pitchClass for p in n.pitches], n.quarterLength)
+        if isinstance(n, chord.Chord):
+            n = max(n)
+        note_lengths[n.quarterLength] = note_lengths.get(n.quarterLength, 0) + 1
+        note_count += 1.0
+        if not n.isRest:
+            all_pitches.append(n.pitch.ps)
+        if n.tie and (n.tie.type == 'stop' or n.tie.type == 'continue'): #do not count a tied note more than once
+            continue
+        if not n.isRest:
+            untied_pcs.append(n.pitch.pitchClass)
+            untied_pitches.append(n.pitch.ps)
+        if n.isRest or (len(n.expressions) != 0 and 'fermata' == n.expressions[0].name):
+            phrases.append(phrase)
+            phrase = []
+        else:
+            phrase.append(n.pitch.ps)
+    #reached end, keep the last phrase if it has any notes
+    if len(phrase) != 0:
+        phrases.append(phrase)
+
+    #musical attributes
+    meter_tup = (first_meter.numerator, first_meter.denominator) if first_meter is not None else (0, 0)
+    key_sharps = first_key.sharps if first_key is not None else 0
+    part_names = [part.partName for part in score.parts]
+    musical_attr = [meter_tup, key_sharps, len(part_names), part_names]
+
+    vector = note_length_vector(note_lengths, note_count)
+
+    #average phrase length
+    avg_length = sum(len(p) for p in phrases)/len(phrases) if len(phrases) != 0 else None
+
+    #key confidence and proportion of notes within the key
+    nonharmonics = None
+    if len(untied_pcs) != 0:
+        #several parts or voices are summed in offset order, like analyze('key') does, so the result is identical
+        key_sig = analyze_key(score_histogram(score) if is_polyphonic else tuple(histogram))
+        num_nonharmonic = sum(1 for pc in untied_pcs if pc not in key_sig.pitch_classes)
+        nonharmonics = (key_sig.certainty, 1-num_nonharmonic/len(untied_pcs))
+
+    #interval distribution and fingerprint; with several parts or voices the notes must be taken in offset order instead
+    if is_polyphonic:
+        all_pitches, untied_pitches = [], []
+        for n in score.flatten().notes:
+            ps = max(n).pitch.ps if isinstance(n, chord.Chord) else n.pitch.ps
+            all_pitches.append(ps)
+            if not (n.tie and (n.tie.type == 'stop' or n.tie.type == 'continue')):
+                untied_pitches.append(ps)
+    intervals = interval_distribution(all_pitches)
+
+    arch_lengths, arch_profiles = melodic_arch_profiles(phrases)
+
+    if path is not None:
+        name = piece_name_from_filename(Path(path).name)
+    else:
+        name = piece_name(score)
+
+    return PieceFeatures(
+        metadata=metadata_attributes(score),
+        musical_attr=musical_attr,
+        note_lengths=vector,
+        phrase_lengths=avg_length,
+        name=name,
+        nonharmonics=nonharmonics,
+        intervals=intervals,
+        arch_lengths=arch_lengths,
+        arch_profiles=arch_profiles,
+        shingles=interval_shingles(untied_pitches),
+    )
+
+
+"""
+Same features as extract_features, from a Melody read by score_reader instead of a music21 score
+"""
+@instrumentation.instrumented('extract.melody_features')
+def melody_features(melody, path):
+    from score_reader import TIE_CONTINUE, TIE_STOP
+
+    note_lengths = dict()
+    for ql in melody.quarter_length.tolist():
+        note_lengths[ql] = note_lengths.get(ql, 0) + 1
+    sounding = ~melody.rest
+    untied = ~np.isin(melody.tie, (TIE_CONTINUE, TIE_STOP)) #do not count a tied note more than once
+
+    phrases = []
+    phrase = []
+    for ps, rest, fermata in zip(melody.ps[untied].tolist(), melody.rest[untied].tolist(), melody.fermata[untied].tolist()):
+        if rest or fermata:
+            phrases.append(phrase)
+            phrase = []
+        else:
+            phrase.append(ps)
+    if len(phrase) != 0:
+        phrases.append(phrase)
+
+    meter_tup = melody.meter if melody.meter is not None else (0, 0)
+    key_sharps = melody.key_sharps if melody.key_sharps is not None else 0
+    musical_attr = [meter_tup, key_sharps, len(melody.part_names), list(melody.part_names)]
+
+    avg_length = sum(len(p) for p in phrases)/len(phrases) if len(phrases) != 0 else None
+
+    nonharmonics = None
+    untied_pcs = np.mod(melody.ps[untied & sounding], 12).astype(int)
+    if len(untied_pcs) != 0:
+        key_sig = melody_key(melody)
+        num_nonharmonic = int(np.count_nonzero(~np.isin(untied_pcs, list(key_sig.pitch_classes))))
+        nonharmonics = (key_sig.certainty, 1-num_nonharmonic/len(untied_pcs))
+
+    arch_lengths, arch_profiles = melodic_arch_profiles(phrases)
+
+    return PieceFeatures(
+        metadata=melody.metadata,
+        musical_attr=musical_attr,
+        note_lengths=note_length_vector(note_lengths, float(len(melody))),
+        phrase_lengths=avg_length,
+        name=piece_name_from_filename(Path(path).name),
+        nonharmonics=nonharmonics,
+        intervals=interval_distribution(melody.ps[sounding].tolist()),
+        arch_lengths=arch_lengths,
+        arch_profiles=arch_profiles,
+        shingles=interval_shingles(melody.ps[untied & sounding].tolist()),
+    )
+
+
+"""
+Features of every piece in a NoteTable, in the table's order
+"""
+def note_table_features(table):
+    return [melody_features(table.melody(i), name) for i, name in enumerate(table.names)]
+
+
+"""
+Key analysis of a Melody, from the pitch classes and durations of its notes
+"""
+def melody_key(melody):
+    histogram = [0] * 12
+    for ps, ql in zip(melody.ps[~melody.rest].tolist(), melody.quarter_length[~melody.rest].tolist()):
+        add_to_histogram(histogram, (int(ps) % 12,), ql)
+    return analyze_key(tuple(histogram))
+
+
+"""
+Proportion of notes of each length, in increments of sixteenths up until a whole note
+"""
+def note_length_vector(note_lengths: dict, note_count: float):
+    vector = []
+    i = 0
+    while i < 4:
+        i += 0.25
+        vector.append(note_lengths[i]/note_count if i in note_lengths else 0)
+    return vector
+
+
+"""
+Distribution of melodic intervals up to an octave either way between consecutive pitches
+"""
+def interval_distribution(pitches: list):
+    ints = np.zeros(25)
+    for p1, p2 in zip(pitches[:-1], pitches[1:]):
+        curr_int = int(p2 - p1)
+        if abs(curr_int) <= 12:
+            ints[abs(curr_int) + 12] += 1
+    return ints / ints.sum()
+
+
+"""
+Transposition- and tempo-invariant fingerprint of a melody: every run of SHINGLE_LENGTH successive intervals
+between its (untied) notes, with each interval in one byte of an integer, sorted and without duplicates.
+Durations are ignored, so the same tune in another key or at another speed has the same shingles.
+A melody too short for a whole run gets one shorter shingle of all its intervals
+"""
+def interval_shingles(pitches: list, length=SHINGLE_LENGTH):
+    if len(pitches) < 2:
+        return np.zeros(0, dtype=np.uint64)
+    intervals = (np.clip(np.rint(np.diff(pitches)), -127, 127) + 128).astype(np.uint64) #never 0, so shorter shingles differ from longer ones
+    length = min(length, len(intervals))
+    windows = np.lib.stride_tricks.sliding_window_view(intervals, length)
+    return np.unique((windows << (np.arange(length, dtype=np.uint64) * np.uint64(8))).sum(axis=1, dtype=np.uint64))
+
+
+"""
+Melodic arch of every phrase length that occurs, from the pitch heights of each phrase.
+Returns the sorted lengths and all the arches concatenated into one array
+"""
+@instrumentation.instrumented('extract.melodic_arch_profiles')
+def melodic_arch_profiles(phrases: list):
+    sums = dict() #phrase length -> [sum of heights for each note position, number of phrases]
+    for phrase in phrases:
+        if len(phrase) == 0:
+            continue
+        if len(phrase) not in sums:
+            sums[len(phrase)] = [[0 for i in range(len(phrase))], 0]
+        entry = sums[len(phrase)]
+        entry[1] += 1
+        for i in range(len(phrase)):
+            entry[0][i] += phrase[i] - 60 #60 is middle C
+    lengths = sorted(sums)
+    profiles = [height/sums[length][1] for length in lengths for height in sums[length][0]]
+    return np.array(lengths, dtype=np.int32), np.array(profiles, dtype=np.float64)
+
+
+"""
+Looks up the precomputed melodic arch of a piece for phrases of one length, None if it has no such phrases
+"""
+def arch_profile(d, phrase_length: int):
+    lengths = d['arch_lengths']
+    i = np.searchsorted(lengths, phrase_length)
+    if i == len(lengths) or lengths[i] != phrase_length:
+        return None
+    start = int(lengths[:i].sum())
+    return d['arch_profiles'][start:start + phrase_length]
+
+
+"""
+Returns the composer listed in a piece's metadata, None if there is none
+"""
+def get_composer(metadata):
+    composer = None
+    for tup in metadata:
         if tup[0] == 'composer':
-            comp2 = tup[1]
+            composer = tup[1]
+    return composer
+
+"""
+Whether two composer names refer to the same composer
+"""
+def composers_match(comp1, comp2):
     same_composer = False
     if comp1 != None and comp2 != None:
         if (comp1 == comp2 or comp1 in comp2 or comp2 in comp1):
@@ -217,58 +576,52 @@ def similarity(s1: stream.Stream, s2: stream.Stream, d1=None, d2=None):
                     if word in word2 or word2 in word:
                         same_composer = True
                         break
-    
-    max_score += 3
-    if same_composer:
-        # print("Composer: same composer")
-        score += 3 #more weight on composer
-    else:
-        # print("Composer: different composer")
-        pass
-
-    #comparing basic musical data
-    ms1 = d1['musical_attr'] if d1 else musical_attributes(s1)
-    ms2 = d2['musical_attr'] if d2 else musical_attributes(s2)
-    max_score += 3
-    if ms1[0] == ms2[0]:
-        # print("Meter: same meter")
-        score += 1
-    else:
-        # print("Meter: different meter")
-        pass
-    if ms1[1] == ms2[1]:
-        # print("Key: same key")
-        score += 1
-    else:
-        # print("Key: different key")
-        pass
-    if set(ms1[3]) == set(ms2[3]):
-        # print("Instrumentation: same")
-        score += 1
-    else:
-        # print("Instrumentation: different")
-        pass
+    return same_composer
+
+"""
+Cosine similarity of two interval distributions.
+Bins are summed one at a time, in order, so the batch engine can reproduce it exactly
+"""
+def interval_cosine(intervals1, intervals2):
+    dot, norm1, norm2 = 0.0, 0.0, 0.0
+    for a, b in zip(intervals1.tolist(), intervals2.tolist()):
+        dot += a * b
+        norm1 += a * a
+        norm2 += b * b
+    return dot / np.sqrt(norm1 * norm2)
+
+
+"""
+The components similarity() adds up, each as an unweighted (score, most it can score) pair.
+The most is 1 for every component but the melodic arch, which has one term for each phrase length it compares
+"""
+def _composer_similarity(d1, d2):
+    same_composer = composers_match(get_composer(d1['metadata']), get_composer(d2['metadata']))
+    return (1 if same_composer else 0), 1
+
+def _meter_similarity(d1, d2):
+    return (1 if d1['musical_attr'][0] == d2['musical_attr'][0] else 0), 1
+
+def _key_similarity(d1, d2):
+    return (1 if d1['musical_attr'][1] == d2['musical_attr'][1] else 0), 1
+
+def _instrumentation_similarity(d1, d2):
+    return (1 if set(d1['musical_attr'][3]) == set(d2['musical_attr'][3]) else 0), 1
 
-    #comparing note lengths
-    n1 = d1['note_lengths'] if d1 else get_note_lengths(s1)
-    n2 = d2['note_lengths'] if d2 else get_note_lengths(s2)
+def _note_length_similarity(d1, d2):
+    n1 = d1['note_lengths']
+    n2 = d2['note_lengths']
     note_length_similarites = [min(n1[i], n2[i])/max(n1[i], n2[i]) if max(n1[i], n2[i]) != 0  else 1 for i in range(16)]
-    avg_note_length_similarity = sum(note_length_similarites)/16.0
-    # print("Average note length similarity: %.4f" % avg_note_length_similarity)
-    max_score += 1
-    score += avg_note_length_similarity
-
-    #comparing phrase lengths
-    pl1 = d1['phrase_lengths'] if d1 else avg_phrase_length(s1)
-    pl2 = d2['phrase_lengths'] if d2 else avg_phrase_length(s2)
-    phrase_length_similarity = min(pl1, pl2)/max(pl1, pl2) if max(pl1, pl2) != 0 else 1
-    # print("Average phrase length similarity: %.4f" % phrase_length_similarity)
-    max_score += 1
-    score += phrase_length_similarity
-
-    #comparing common piece types/names
-    p1 = d1['name'] if d1 else piece_name(s1)
-    p2 = d2['name'] if d2 else piece_name(s2)
+    return sum(note_length_similarites)/16.0, 1
+
+def _phrase_length_similarity(d1, d2):
+    pl1 = d1['phrase_lengths']
+    pl2 = d2['phrase_lengths']
+    return (min(pl1, pl2)/max(pl1, pl2) if max(pl1, pl2) != 0 else 1), 1
+
+def _piece_type_similarity(d1, d2):
+    p1 = d1['name']
+    p2 = d2['name']
     matches = 0
     total = 0
     for i in range(6):
@@ -277,43 +630,35 @@ def similarity(s1: stream.Stream, s2: stream.Stream, d1=None, d2=None):
             matches += 1
         elif not (p1[i] == 0 and p2[i] == 0):
             total += 1
-    max_score += 1
-    if total == 0:
-        # print("Common piece type similarity: 0")
-        pass
-    else:
-        # print("Common piece type similarity: %.4f" % (matches/total))
-        score += matches/total
+    return (matches/total if total != 0 else 0), 1
 
-    #comparing key confidence and nonharmonic tones
-    nn1 = d1['nonharmonics'] if d1 else nonharmonic_notes(s1)
-    nn2 = d2['nonharmonics'] if d2 else nonharmonic_notes(s2)
+def _key_confidence_similarity(d1, d2):
+    nn1 = d1['nonharmonics']
+    nn2 = d2['nonharmonics']
     key_confidence = min(nn1[0], nn2[0])/max(nn1[0], nn2[0]) if max(nn1[0], nn2[0]) != 0 else 1
-    # print("Key analysis confidence similarity: %.4f" % key_confidence)
-    max_score += 2
-    score += 2 * key_confidence #more weight placed on key confidence
+    return key_confidence, 1
 
+def _tonality_similarity(d1, d2):
+    nn1 = d1['nonharmonics']
+    nn2 = d2['nonharmonics']
     prop_atonal = min(nn1[1], nn2[1])/max(nn1[1], nn2[1]) if max(nn1[1], nn2[1]) != 0 else 1
-    # print("Proportion of nonharmonic notes similarity: %.4f" % prop_atonal)
-    max_score += 2
-    score += 2 * prop_atonal #more weight placed on tonality
-
-    intervals1 = d1['intervals'] if d1 else get_intervals(s1)
-    intervals2 = d2['intervals'] if d2 else get_intervals(s2)
-    interval_dot = np.dot(intervals1, intervals2) / np.sqrt(np.dot(intervals1, intervals1) * np.dot(intervals2, intervals2))
-    # print("Interval distribution similarity metric: %.4f" % interval_dot)
-    max_score += 1
-    score += interval_dot
-
-    #comparing melodic arch
+    return prop_atonal, 1
+
+def _interval_similarity(d1, d2):
+    return interval_cosine(d1['intervals'], d2['intervals']), 1
+
+"""
+One term for every phrase length from 5 up to the average of the two pieces' phrase lengths plus 5 that both have an arch for
+"""
+def _melodic_arch_similarity(d1, d2):
+    pl1 = d1['phrase_lengths']
+    pl2 = d2['phrase_lengths']
     limit_phrase_length = int((pl1+pl2)/2.0 + 5)
     all_diffs = []
     for i in range(5, limit_phrase_length):
-        arch1 = melodic_arch(s1, i)
-        arch2 = melodic_arch(s2, i)
+        arch1 = arch_profile(d1, i)
+        arch2 = arch_profile(d2, i)
         if arch1 is None or arch2 is None:
-            # print("Arch difference for length %d phrases: n/a" % i)
-            limit_phrase_length -= 1
             continue
         sim = 0
         for n in range(i):
@@ -322,18 +667,181 @@ def similarity(s1: stream.Stream, s2: stream.Stream, d1=None, d2=None):
             else:
                 diff = abs(arch1[n] - arch2[n])
                 sim += diff
-        sim /= i #average difference 
-        # print("Arch similarity for length %d phrases: %.4f" % (i, 1.0/sim))
+        sim /= i #average difference
         all_diffs.append(min(1.0, 1.0/sim) if sim > 0 else 1)
-    
-    max_score += len(all_diffs)
-    score += sum(all_diffs)
-    
+    return sum(all_diffs), len(all_diffs)
+
+SIMILARITY_COMPONENTS = (
+    ('composer', _composer_similarity),
+    ('meter', _meter_similarity),
+    ('key', _key_similarity),
+    ('instrumentation', _instrumentation_similarity),
+    ('note_lengths', _note_length_similarity),
+    ('phrase_lengths', _phrase_length_similarity),
+    ('piece_type', _piece_type_similarity),
+    ('key_confidence', _key_confidence_similarity),
+    ('tonality', _tonality_similarity),
+    ('intervals', _interval_similarity),
+    ('melodic_arch', _melodic_arch_similarity),
+)
+
+"""
+How much each component counts: a component that scores s of at most m adds weight * s to the score and weight * m
+to the most it can be, and the similarity is their ratio. Each melodic arch term is weighted separately
+"""
+DEFAULT_WEIGHTS = {
+    'composer': 3, #more weight on composer
+    'meter': 1,
+    'key': 1,
+    'instrumentation': 1,
+    'note_lengths': 1,
+    'phrase_lengths': 1,
+    'piece_type': 1,
+    'key_confidence': 2, #more weight placed on key confidence
+    'tonality': 2, #and on tonality
+    'intervals': 1,
+    'melodic_arch': 1,
+}
+
+
+@lru_cache(maxsize=None)
+def _weight_list(profile: tuple):
+    weights = dict(profile)
+    unknown = set(weights) - set(DEFAULT_WEIGHTS)
+    if unknown:
+        raise ValueError('unknown similarity components: %s' % ', '.join(sorted(unknown)))
+    return tuple(weights.get(name, DEFAULT_WEIGHTS[name]) for name, _ in SIMILARITY_COMPONENTS)
+
+"""
+The weight of every component, in the order of SIMILARITY_COMPONENTS, for a weight profile: a dict from component
+names to weights, where components that are left out keep their default weight
+"""
+def weight_list(weights=None):
+    return _weight_list(tuple(sorted((weights or dict()).items())))
+
+
+"""
+The weight profile of a weight list, e.g. the one a similarity store records
+"""
+def weight_profile(weights):
+    if len(weights) != len(SIMILARITY_COMPONENTS):
+        raise ValueError('%d weights for %d similarity components' % (len(weights), len(SIMILARITY_COMPONENTS)))
+    return {name: weight for (name, _), weight in zip(SIMILARITY_COMPONENTS, weights)}
+
+
+"""
+Reads a weight profile from a JSON file holding one {component: weight} object
+"""
+def load_weights(path):
+    import json
+    with open(path) as f:
+        weights = json.load(f)
+    weight_list(weights) #fail early on unknown components
+    return weights
+
+
+"""
+Breakdown of similarity(d1=d1, d2=d2, weights=weights): the weighted (score, most it can score) of each component,
+in the order they are added up. The similarity is the sum of the scores over the sum of the maxima
+"""
+def similarity_components(d1, d2, weights=None):
+    components = dict()
+    for (name, component), weight in zip(SIMILARITY_COMPONENTS, weight_list(weights)):
+        if instrumentation.enabled:
+            start = time.perf_counter()
+            score, most = component(d1, d2)
+            instrumentation.METRICS.observe('similarity.' + name, time.perf_counter() - start)
+        else:
+            score, most = component(d1, d2)
+        components[name] = (weight * score, weight * most)
+    return components
+
 
+"""
+Computes similarity between two pieces based on musical attributes, ideally.
+weights is a weight profile overriding DEFAULT_WEIGHTS for some components
+"""
+def similarity(s1: stream.Stream, s2: stream.Stream, d1=None, d2=None, weights=None):
+    #only the extracted features are compared, so the streams are not needed when both are given
+    if d1 is None:
+        d1 = extract_features(s1)
+    if d2 is None:
+        d2 = extract_features(s2)
+    if instrumentation.enabled:
+        components = similarity_components(d1, d2, weights).values()
+    else:
+        components = [(weight * score, weight * most) for (score, most), weight in
+                      zip([component(d1, d2) for _, component in SIMILARITY_COMPONENTS], weight_list(weights))]
+    max_score, score = 0, 0
+    for component_score, component_max in components:
+        score += component_score
+        max_score += component_max
     return score/max_score
 
 
 
+"""
+weight_list(weights) for the scorers that prune pairs by an upper bound on their score (bounded_similarity,
+similarity_matrix.top_similar). The bounds take every component to add at most its weight times its most,
+which only holds for weights that are not negative
+"""
+def bound_weight_list(weights=None):
+    weights = weight_list(weights)
+    if min(weights) < 0:
+        raise ValueError('upper bounds on similarity need weights that are not negative')
+    return weights
+
+
+#the order bounded_similarity scores the components in: cheap ones first, the melodic arch last
+BOUNDED_STAGES = (
+    ('composer', 'meter', 'key', 'instrumentation'),
+    ('intervals', 'key_confidence', 'tonality', 'phrase_lengths'),
+    ('piece_type', 'note_lengths'),
+)
+
+"""
+BOUNDED_STAGES as (position in SIMILARITY_COMPONENTS, component, weight) for every component, for a bound_weight_list
+"""
+@lru_cache(maxsize=None)
+def _bounded_stages(weights: tuple):
+    position = {name: i for i, (name, _) in enumerate(SIMILARITY_COMPONENTS)}
+    return tuple(tuple((position[name], SIMILARITY_COMPONENTS[position[name]][1], weights[position[name]]) for name in stage)
+                 for stage in BOUNDED_STAGES)
+
+"""
+The same score as similarity(d1=d1, d2=d2, weights=weights), or None as soon as it is clear the score cannot reach threshold.
+With m melodic arch terms, the most a pair can score is the sum of the other weights plus m times the arch weight.
+The components are scored a stage of BOUNDED_STAGES at a time, and after each stage the score is at most
+what the components scored so far add up to plus the weighted most of the ones left, arch terms included.
+Components are added up in the same order as similarity(), so scores that are returned are identical to it
+"""
+def bounded_similarity(d1, d2, threshold, weights=None):
+    weights = bound_weight_list(weights)
+    pl1, pl2 = d1['phrase_lengths'], d2['phrase_lengths']
+    limit_phrase_length = int((pl1+pl2)/2.0 + 5)
+    lengths2 = set(d2['arch_lengths'].tolist())
+    max_arches = sum(1 for length in d1['arch_lengths'].tolist() if 5 <= length < limit_phrase_length and length in lengths2)
+    max_score = sum(weights[:-1]) + weights[-1] * max_arches
+    remaining = max_score
+
+    scored = [None] * len(SIMILARITY_COMPONENTS)
+    partial = 0
+    for stage in _bounded_stages(weights):
+        for i, component, weight in stage:
+            scored[i] = component(d1, d2)
+            partial += weight * scored[i][0]
+            remaining -= weight * scored[i][1]
+        if (partial + remaining)/max_score < threshold - 1e-9: #with a little slack so rounding never prunes a pair that reaches threshold
+            return None
+
+    scored[-1] = _melodic_arch_similarity(d1, d2)
+    score, max_score = 0, 0
+    for (component_score, component_max), weight in zip(scored, weights):
+        score += weight * component_score
+        max_score += weight * component_max
+    return score/max_score
+
+
 if __name__ == "__main__":
 
     piece0 = converter.parse('essen/asia/china/han/han0001.krn')
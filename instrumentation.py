@@ -0,0 +1,244 @@
+import argparse
+import atexit
+import json
+import os
+import re
+import time
+from bisect import bisect_left
+from functools import wraps
+
+"""
+Opt-in instrumentation: timings with latency histograms, counters and cache hit rates, exported as JSON or
+Prometheus text. Everything is off unless enable() is called or RECOMMENDER_METRICS is set; while it is off
+each hook costs one check of the module-level enabled flag
+"""
+
+METRICS_ENV = 'RECOMMENDER_METRICS' #set to a .json or .prom path to record metrics for a whole run and write them there on exit
+LATENCY_BUCKETS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0) #histogram bucket upper bounds, in seconds
+
+enabled = False
+
+
+"""
+Call count, total and maximum time and a histogram over LATENCY_BUCKETS (plus one bucket for anything slower)
+of one timed operation
+"""
+class Timer(object):
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.timers = dict()
+        self.counters = dict()
+        self.caches = dict() #name -> [hits, misses]
+        self.cache_sources = dict() #name -> (functools.lru_cache cache_info, its hits and misses at the last reset)
+
+    def observe(self, name, seconds):
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = Timer()
+        timer.observe(seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def cache(self, name, hits=0, misses=0):
+        counts = self.caches.setdefault(name, [0, 0])
+        counts[0] += hits
+        counts[1] += misses
+
+    """
+    Reports the hits and misses of an lru_cache (pass its cache_info) along with the other caches
+    """
+    def register_cache(self, name, cache_info):
+        info = cache_info()
+        self.cache_sources[name] = (cache_info, info.hits, info.misses)
+
+    def reset(self):
+        self.timers.clear()
+        self.counters.clear()
+        self.caches.clear()
+        for name, (cache_info, _, _) in self.cache_sources.items():
+            self.register_cache(name, cache_info)
+
+    """
+    Everything recorded since the last reset as plain data, which merge() can add to another process's metrics
+    """
+    def snapshot(self):
+        caches = {name: list(counts) for name, counts in self.caches.items()}
+        for name, (cache_info, hits, misses) in self.cache_sources.items():
+            info = cache_info()
+            counts = caches.setdefault(name, [0, 0])
+            counts[0] += info.hits - hits
+            counts[1] += info.misses - misses
+        return {
+            'timers': {name: {'count': t.count, 'total': t.total, 'max': t.max, 'buckets': list(t.buckets)} for name, t in self.timers.items()},
+            'counters': dict(self.counters),
+            'caches': {name: {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else None}
+                       for name, (hits, misses) in caches.items()},
+        }
+
+    def merge(self, snapshot):
+        for name, t in snapshot['timers'].items():
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = Timer()
+            timer.count += t['count']
+            timer.total += t['total']
+            timer.max = max(timer.max, t['max'])
+            timer.buckets = [a + b for a, b in zip(timer.buckets, t['buckets'])]
+        for name, n in snapshot['counters'].items():
+            self.count(name, n)
+        for name, c in snapshot['caches'].items():
+            self.cache(name, c['hits'], c['misses'])
+
+    def to_json(self):
+        snapshot = self.snapshot()
+        for t in snapshot['timers'].values():
+            t['mean'] = t['total'] / t['count'] if t['count'] else None
+            t['buckets'] = dict(zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'], t['buckets']))
+        return json.dumps(snapshot, indent=1, sort_keys=True)
+
+    """
+    The metrics in the Prometheus text format: every timer as a histogram in seconds, counters as counters and
+    cache hits and misses as counters labelled with the cache's name
+    """
+    def to_prometheus(self, prefix='recommender'):
+        def metric_name(name):
+            return re.sub(r'[^a-zA-Z0-9_]', '_', '%s_%s' % (prefix, name))
+
+        snapshot = self.snapshot()
+        lines = []
+        for name, t in sorted(snapshot['timers'].items()):
+            metric = metric_name(name) + '_seconds'
+            lines.append('# TYPE %s histogram' % metric)
+            cumulative = 0
+            for bound, n in zip(list(LATENCY_BUCKETS) + ['+Inf'], t['buckets']):
+                cumulative += n
+                lines.append('%s_bucket{le="%s"} %d' % (metric, bound, cumulative))
+            lines.append('%s_sum %r' % (metric, t['total']))
+            lines.append('%s_count %d' % (metric, t['count']))
+        for name, n in sorted(snapshot['counters'].items()):
+            lines.append('# TYPE %s_total counter' % metric_name(name))
+            lines.append('%s_total %d' % (metric_name(name), n))
+        if snapshot['caches']:
+            for kind in ('hits', 'misses'):
+                lines.append('# TYPE %s_cache_%s_total counter' % (prefix, kind))
+                for name, c in sorted(snapshot['caches'].items()):
+                    lines.append('%s_cache_%s_total{cache="%s"} %d' % (prefix, kind, name, c[kind]))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+class _Timed(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        METRICS.observe(self.name, time.perf_counter() - self.start)
+
+
+class _NotTimed(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+NOT_TIMED = _NotTimed()
+
+
+"""
+Context manager timing its block under name, or doing nothing while instrumentation is off
+"""
+def timed(name):
+    return _Timed(name) if enabled else NOT_TIMED
+
+
+"""
+Decorator timing every call of a function under name
+"""
+def instrumented(name):
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                METRICS.observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def count(name, n=1):
+    if enabled:
+        METRICS.count(name, n)
+
+
+"""
+Writes the metrics to path, as Prometheus text if it ends in .prom and as JSON otherwise
+"""
+def write_metrics(path):
+    with open(path, 'w') as f:
+        f.write(METRICS.to_prometheus() if str(path).endswith('.prom') else METRICS.to_json())
+
+
+if os.environ.get(METRICS_ENV):
+    enable()
+    atexit.register(write_metrics, os.environ[METRICS_ENV])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Explains the similarity score of two pieces component by component')
+    parser.add_argument('piece1')
+    parser.add_argument('piece2')
+    parser.add_argument('--store', default='feature_store', help='feature store to read the pieces\' features from')
+    parser.add_argument('--weights', default=None, help='JSON weight profile to explain the score under')
+    args = parser.parse_args()
+
+    import pickle
+    from pathlib import Path
+    from build_features import feature_path, load_feature_index
+    from functions import load_weights, similarity_components
+
+    digests = {Path(path).name: digest for path, digest in load_feature_index(args.store).items()}
+    features = []
+    for name in (args.piece1, args.piece2):
+        with open(feature_path(args.store, digests[Path(name).name]), 'rb') as handle:
+            features.append(pickle.load(handle))
+    components = similarity_components(*features, weights=load_weights(args.weights) if args.weights else None)
+    max_score = sum(most for _, most in components.values())
+    for name, (score, most) in components.items():
+        print('%-16s %6.3f of %4g  (%+.3f)' % (name, score, most, score / max_score))
+    print('%-16s %6.3f' % ('similarity', sum(score for score, _ in components.values()) / max_score))
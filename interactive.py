@@ -1,46 +1,89 @@
+import threading
 import numpy as np
-import pandas as pd
+from functools import lru_cache
 from pathlib import Path
-from music21 import converter
-from music21.midi.realtime import StreamPlayer
+import instrumentation
+from catalogue import CATALOGUE, build_catalogue, load_catalogue
+from topk_index import TOPK_INDEX, SparsePreferences
 
-print('loading streams...')
+#music21 (and pandas, for converting an old CSV) are only imported when first needed, so startup stays fast
 
-df = pd.read_csv('all_pairs_similarity.csv', index_col=False)
+SIMILARITY_STORE = 'all_pairs_similarity.sim'
+STREAM_CACHE_SIZE = 16 #parsed streams kept in memory
 
-names = list(set(df['name1']))
-name_map = {name: i for i, name in enumerate(names)}
+print('loading precomputed data...')
 
-stream_map = {}
-for path in Path('essen').rglob('*.krn'):
-    if path.name in name_map:
-    	sc = converter.parse(path)
-    	part = sc.parts[0]
-    	while len(part) > 10:
-    		part.pop(-1)
-    	stream_map[path.name] = sc
+#one snapshot holds the names, score paths and each song's nearest neighbours, not the full similarity matrix
+catalogue = load_catalogue(CATALOGUE)
+if catalogue is None:
+	if not Path(TOPK_INDEX).exists():
+		from similarity_store import load_similarity_store, convert_csv
+		from topk_index import build_topk_index, save_topk_index
+		if not Path(SIMILARITY_STORE).exists():
+			convert_csv('all_pairs_similarity.csv', SIMILARITY_STORE)
+		names, similarity_arr = load_similarity_store(SIMILARITY_STORE)
+		save_topk_index(TOPK_INDEX, names, *build_topk_index(similarity_arr))
+	catalogue = build_catalogue(CATALOGUE, TOPK_INDEX, store_path=SIMILARITY_STORE)
+names, neighbours, neighbour_scores = catalogue.names, catalogue.neighbours, catalogue.scores
+path_map = catalogue.path_map
 
-print('loading precomputed data...')
+stream_lock = threading.Lock()
 
-similarity_arr = np.empty((len(names), len(names)))
-similarity_arr[:] = np.nan
+"""
+Parses the opening of a song, only when it is first needed
+"""
+@lru_cache(maxsize=STREAM_CACHE_SIZE)
+def parse_stream(name):
+	from music21 import converter
+	with instrumentation.timed('parse.music21'):
+		sc = converter.parse(path_map[name])
+	part = sc.parts[0]
+	while len(part) > 10:
+		part.pop(-1)
+	return sc
 
-np.fill_diagonal(similarity_arr, 1)
+instrumentation.METRICS.register_cache('streams', parse_stream.cache_info)
 
-for _, row in df.iterrows():
-	if row['name1'] in name_map and row['name2'] in name_map:
-		similarity_arr[name_map[row['name1']], name_map[row['name2']]] = row['score']
+def load_stream(name):
+	with stream_lock:
+		return parse_stream(name)
 
-input('loaded! Press enter to begin...')
-print('')
+def prefetch_streams(song_names):
+	for name in song_names:
+		load_stream(name)
 
-prefs = np.zeros(len(names))
+"""
+Recency-weighted preferences after the user likes or dislikes the current song, and the top 3 songs for them
+"""
+@instrumentation.instrumented('recommend.step')
+def recommend(prefs, curr, liked):
+	prefs = prefs.copy()
+	prefs.update(neighbours, neighbour_scores, curr, liked)
+	return prefs, prefs.top(3)
 
-curr = np.random.randint(len(names))
+#only songs with a score file can be played: never start on or recommend the others, e.g. pieces removed from the corpus
+playable = np.array([name in path_map for name in names])
+#dislikes move away from the disliked song's whole row of the similarity store, not just from its neighbours
+if catalogue.similarity() is None:
+	print('%s not found, dislikes only move away from the nearest neighbours' % catalogue.store_path)
+prefs = SparsePreferences(len(names), catalogue.similarity())
+prefs.exclude(np.flatnonzero(~playable))
+
+curr = np.random.choice(np.flatnonzero(playable))
+#music21 is imported and the first song parsed while the user reads the prompt
+threading.Thread(target=prefetch_streams, args=([names[curr]],), daemon=True).start()
+
+input('loaded! Press enter to begin...')
+print('')
 
 while curr != -1:
+	from music21.midi.realtime import StreamPlayer
 	curr_name = names[curr]
-	sp = StreamPlayer(stream_map[curr_name])
+	sp = StreamPlayer(load_stream(curr_name))
+	#whichever way the user answers, the next recommendations are parsed while this song plays
+	outcomes = {liked: recommend(prefs, curr, liked) for liked in (True, False)}
+	upcoming = [names[t] for _, top in outcomes.values() for t in top]
+	threading.Thread(target=prefetch_streams, args=(upcoming,), daemon=True).start()
 	print('now playing %s' % curr_name)
 	sp.play()
 	ans = input('did you like it (q to quit)? (y)/n: ')
@@ -48,10 +91,7 @@ while curr != -1:
 	if ans == 'q':
 		break
 
-	prefs /= 2
-	prefs += similarity_arr[curr] * (-1 if ans == 'n' else 1)
-	prefs[curr] = -np.inf
-	top = np.argsort(-prefs)[:3]
+	prefs, top = outcomes[ans != 'n']
 	for i, t in enumerate(top):
 		print('%d. %s' % (i + 1, names[t]))
 	try:
@@ -0,0 +1,151 @@
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+
+from score_reader import Melody
+
+NOTE_TABLE = 'essen_data/notes.npz'
+FLAG_REST, FLAG_FERMATA = 1, 2
+
+#token classes for the LSTM: pitch space values 0-108, then a rest and an unknown class
+NUM_CLASSES = 111
+REST_CLASS = 109
+UNK_CLASS = 110
+
+
+"""
+Every note of a corpus in a handful of contiguous arrays, with piece i's notes at offsets[i]:offsets[i + 1].
+Pitches are pitch space values (nan for rests) and flags holds FLAG_REST and FLAG_FERMATA bits.
+Per-piece attributes are arrays too, except metadata and part names, which are kept as lists
+"""
+class NoteTable(object):
+    __slots__ = ('names', 'offsets', 'ps', 'quarter_length', 'tie', 'flags', 'meters', 'key_sharps', 'metadata', 'part_names')
+
+    def __init__(self, names, offsets, ps, quarter_length, tie, flags, meters, key_sharps, metadata, part_names):
+        self.names = list(names)
+        self.offsets = offsets
+        self.ps = ps
+        self.quarter_length = quarter_length
+        self.tie = tie
+        self.flags = flags
+        self.meters = meters #(0, 0) if the piece has no time signature
+        self.key_sharps = key_sharps
+        self.metadata = metadata
+        self.part_names = part_names
+
+    @classmethod
+    def from_melodies(cls, names, melodies):
+        lengths = [len(m) for m in melodies]
+        concat = lambda arrays, dtype: np.concatenate([np.asarray(a, dtype=dtype) for a in arrays]) if arrays else np.zeros(0, dtype=dtype)
+        return cls(
+            names=names,
+            offsets=np.r_[0, np.cumsum(lengths, dtype=np.int64)],
+            ps=concat([m.ps for m in melodies], np.float32),
+            quarter_length=concat([m.quarter_length for m in melodies], np.float32),
+            tie=concat([m.tie for m in melodies], np.int8),
+            flags=concat([m.rest * FLAG_REST | m.fermata * FLAG_FERMATA for m in melodies], np.uint8),
+            meters=np.array([m.meter or (0, 0) for m in melodies], dtype=np.int16).reshape(-1, 2),
+            key_sharps=np.array([m.key_sharps or 0 for m in melodies], dtype=np.int8),
+            metadata=[tuple(tuple(item) for item in m.metadata) for m in melodies],
+            part_names=[list(m.part_names) for m in melodies],
+        )
+
+    def __len__(self):
+        return len(self.names)
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    """
+    Piece i as a Melody whose pitch, duration and tie arrays are views into the table
+    """
+    def melody(self, i):
+        notes = slice(self.offsets[i], self.offsets[i + 1])
+        meter = tuple(self.meters[i].tolist())
+        return Melody(
+            ps=self.ps[notes],
+            quarter_length=self.quarter_length[notes],
+            tie=self.tie[notes],
+            rest=(self.flags[notes] & FLAG_REST) != 0,
+            fermata=(self.flags[notes] & FLAG_FERMATA) != 0,
+            meter=meter if meter != (0, 0) else None,
+            key_sharps=int(self.key_sharps[i]),
+            metadata=self.metadata[i],
+            part_names=self.part_names[i],
+        )
+
+    """
+    The whole corpus as LSTM token classes, with runs of rests collapsed into one and leading rests dropped.
+    Returns the classes and per-piece offsets into them
+    """
+    def token_classes(self):
+        rest = (self.flags & FLAG_REST) != 0
+        pitched = ~rest & (self.ps >= 0) & (self.ps <= 108)
+        classes = np.full(len(self.ps), UNK_CLASS, dtype=np.int16)
+        classes[rest] = REST_CLASS
+        classes[pitched] = self.ps[pitched].astype(np.int16)
+
+        piece_start = np.zeros(len(self.ps), dtype=bool)
+        piece_start[self.offsets[:-1][self.lengths() > 0]] = True
+        keep = ~(rest & (piece_start | np.r_[False, rest[:-1]]))
+        kept_before = np.r_[0, np.cumsum(keep)]
+        return classes[keep], kept_before[self.offsets]
+
+    def save(self, path):
+        info = json.dumps({'names': self.names, 'metadata': self.metadata, 'part_names': self.part_names}).encode('utf-8')
+        np.savez_compressed(path, info=np.frombuffer(info, dtype=np.uint8), offsets=self.offsets, ps=self.ps, quarter_length=self.quarter_length,
+                 tie=self.tie, flags=self.flags, meters=self.meters, key_sharps=self.key_sharps)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as table:
+            info = json.loads(table['info'].tobytes().decode('utf-8'))
+            return cls(
+                names=info['names'],
+                offsets=table['offsets'],
+                ps=table['ps'],
+                quarter_length=table['quarter_length'],
+                tie=table['tie'],
+                flags=table['flags'],
+                meters=table['meters'],
+                key_sharps=table['key_sharps'],
+                metadata=[tuple(tuple(item) for item in m) for m in info['metadata']],
+                part_names=info['part_names'],
+            )
+
+
+"""
+Reads every score under dirs into a NoteTable. Monophonic kern is read natively; anything else
+is parsed with music21 and only its first part is kept
+"""
+def build_note_table(dirs):
+    from build_features import find_scores
+    from score_reader import read_melody, melody_from_score
+
+    names, melodies = [], []
+    for path in find_scores(dirs):
+        try:
+            melody = read_melody(path)
+            if melody is None:
+                from music21 import converter
+                melody = melody_from_score(converter.parse(path))
+        except Exception as e:
+            print('skipping %s (%s: %s)' % (path, type(e).__name__, e))
+            continue
+        names.append(str(path))
+        melodies.append(melody)
+    return NoteTable.from_melodies(names, melodies)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Reads every score into one note table for feature extraction and training')
+    parser.add_argument('dirs', nargs='*', default=['essen'])
+    parser.add_argument('-o', '--output', default=NOTE_TABLE)
+    args = parser.parse_args()
+
+    table = build_note_table(args.dirs)
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    table.save(args.output)
+    print('wrote %d notes from %d scores to %s' % (len(table.ps), len(table), args.output))
@@ -0,0 +1,114 @@
+import numpy as np
+
+from topk_index import topk_entries
+
+
+"""
+Position of each event among the events with the same row, in the order they were given
+"""
+def _rank_within_rows(rows):
+    order = np.argsort(rows, kind='stable')
+    sorted_rows = rows[order]
+    starts = np.r_[True, sorted_rows[1:] != sorted_rows[:-1]]
+    group_start = np.maximum.accumulate(np.where(starts, np.arange(len(rows)), 0))
+    rank = np.empty(len(rows), dtype=np.int64)
+    rank[order] = np.arange(len(rows)) - group_start
+    return rank
+
+
+"""
+Applies a batch of feedback events to a (users x songs) preference matrix in place, with the
+recency-weighted update from interactive.py: halve the row, add (or subtract, if disliked) the song's
+similarities, then rule the song out. rows[i] listened to songs[i] and liked[i] says whether they liked it.
+All rows are updated together; events for the same row are applied in the order given
+"""
+def apply_feedback(prefs, rows, songs, liked, similarity):
+    rows, songs = np.asarray(rows, dtype=np.int64), np.asarray(songs, dtype=np.int64)
+    signs = np.where(liked, 1, -1).astype(prefs.dtype)
+    rank = _rank_within_rows(rows)
+    for wave in range(rank.max() + 1 if len(rank) else 0):
+        sel = rank == wave
+        r, s = rows[sel], songs[sel]
+        prefs[r] /= 2
+        prefs[r] += np.asarray(similarity[s], dtype=prefs.dtype) * signs[sel][:, None]
+        prefs[r, s] = -np.inf
+
+
+"""
+Same update as apply_feedback, for replaying large logs of feedback in bulk. Repeated halving is folded into
+one weight per event, so a row with m events becomes prefs/2^m plus each song's similarities weighted by
++-1/2^(number of later events), and the whole batch costs one gather of similarity rows.
+Events more than horizon steps before a row's latest one are weighted below 2^-horizon and skipped;
+by default that is once they fall below the precision of prefs' dtype.
+Results match applying the events one at a time up to rounding.
+If played, a boolean (users x songs) array, is given, every song in the batch is marked in it
+"""
+def replay_feedback(prefs, rows, songs, liked, similarity, played=None, horizon=None, block_size=1024):
+    if horizon is None:
+        horizon = np.finfo(prefs.dtype).nmant + 2
+    rows, songs = np.asarray(rows, dtype=np.int64), np.asarray(songs, dtype=np.int64)
+    if not len(rows):
+        return
+    users, inverse, counts = np.unique(rows, return_inverse=True, return_counts=True)
+    age = counts[inverse] - 1 - _rank_within_rows(rows) #0 for a row's latest event
+    weights = np.where(liked, 1.0, -1.0) * np.exp2(-age.astype(np.float64))
+
+    decayed = prefs[users]
+    decayed = np.where(np.isneginf(decayed), -np.inf, decayed * np.exp2(-counts.astype(np.float64))[:, None])
+    prefs[users] = decayed
+
+    #gather the weighted similarity rows of the events that still matter, oldest first within each row
+    kept = np.flatnonzero(age < horizon)
+    kept = kept[np.argsort(inverse[kept], kind='stable')]
+    for start in range(0, len(kept), block_size):
+        events = kept[start:start + block_size]
+        contributions = np.asarray(similarity[songs[events]], dtype=prefs.dtype) * weights[events].astype(prefs.dtype)[:, None]
+        event_users = inverse[events]
+        starts = np.flatnonzero(np.r_[True, event_users[1:] != event_users[:-1]])
+        prefs[users[event_users[starts]]] += np.add.reduceat(contributions, starts, axis=0)
+
+    prefs[rows, songs] = -np.inf
+    if played is not None:
+        played[rows, songs] = True
+
+
+"""
+The k best songs for each of the given rows of a preference matrix, best first, as a (rows x k) array.
+If played, a boolean (users x songs) array, is given, songs marked in it are never recommended
+"""
+def top_k(prefs, rows, k=3, played=None):
+    rows = np.asarray(rows, dtype=np.int64)
+    block = prefs[rows]
+    if played is not None:
+        block[played[rows]] = -np.inf
+    return topk_entries(block, k)[0]
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    import pandas as pd
+    from similarity_store import load_similarity_store
+
+    parser = argparse.ArgumentParser(description='Replays a log of user,song,liked feedback and writes every user\'s top-k')
+    parser.add_argument('log', help='CSV with user, song and liked (1/0) columns, in the order the feedback was given')
+    parser.add_argument('--store', default='all_pairs_similarity.sim')
+    parser.add_argument('-k', type=int, default=3)
+    parser.add_argument('-o', '--output', default='recommendations.csv')
+    args = parser.parse_args()
+
+    names, similarity = load_similarity_store(args.store)
+    name_map = pd.Series(np.arange(len(names)), index=names)
+    log = pd.read_csv(args.log)
+    log = log[log['song'].isin(name_map.index)]
+    rows, users = pd.factorize(log['user'])
+
+    start = time.time()
+    prefs = np.zeros((len(users), len(names)), dtype=np.float32)
+    played = np.zeros(prefs.shape, dtype=bool)
+    replay_feedback(prefs, rows, name_map[log['song']].values, log['liked'].values.astype(bool), similarity, played)
+    top = top_k(prefs, np.arange(len(users)), args.k, played)
+    print('replayed %d events from %d users in %.2fs' % (len(log), len(users), time.time() - start))
+
+    pd.DataFrame({'user': np.repeat(users, top.shape[1]), 'rank': np.tile(np.arange(1, top.shape[1] + 1), len(users)),
+                  'song': np.array(names)[top.ravel()]}).to_csv(args.output, index=False)
@@ -0,0 +1,191 @@
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+
+"""
+Fast reader for monophonic Humdrum **kern files.
+Instead of building a music21 object tree it streams through the text and emits one array per note
+attribute, which is all the extractors in functions.py need
+"""
+
+#tie states, as stored in Melody.tie
+NO_TIE, TIE_START, TIE_CONTINUE, TIE_STOP = 0, 1, 2, 3
+
+STEPS = {'c': 0, 'd': 2, 'e': 4, 'f': 5, 'g': 7, 'a': 9, 'b': 11}
+#sharps in the key signature of each major key, by tonic pitch class; minor keys use their relative major
+MAJOR_KEY_SHARPS = {0: 0, 7: 1, 2: 2, 9: 3, 4: 4, 11: 5, 6: 6, 1: -5, 8: -4, 3: -3, 10: -2, 5: -1}
+HUMDRUM_INSTRUMENTS = {'vox': 'Voice'}
+#reference records with a music21 metadata name; the rest are kept as 'humdrum:<record>'
+HUMDRUM_RECORDS = {'COM': 'composer', 'OTL': 'title', 'SCT': 'scholarlyCatalogAbbreviation', 'EED': 'electronicEditor'}
+
+
+class UnsupportedScore(Exception):
+    pass
+
+
+"""
+One monophonic melody as parallel arrays with one entry per note or rest, in order
+"""
+@dataclass
+class Melody:
+    ps: np.ndarray #pitch space value (60 is middle C), nan for rests
+    quarter_length: np.ndarray
+    tie: np.ndarray #NO_TIE, TIE_START, TIE_CONTINUE or TIE_STOP
+    rest: np.ndarray
+    fermata: np.ndarray
+    meter: tuple = None #(numerator, denominator) of the first time signature
+    key_sharps: int = None #first key signature as a number of sharps (negative for flats)
+    metadata: tuple = ()
+    part_names: list = field(default_factory=list)
+
+    def __len__(self):
+        return len(self.ps)
+
+
+def _melody(notes, **kwargs):
+    ps, ql, tie, rest, fermata = zip(*notes) if notes else ((), (), (), (), ())
+    return Melody(
+        ps=np.array(ps, dtype=np.float64),
+        quarter_length=np.array(ql, dtype=np.float64),
+        tie=np.array(tie, dtype=np.int8),
+        rest=np.array(rest, dtype=bool),
+        fermata=np.array(fermata, dtype=bool),
+        **kwargs
+    )
+
+
+"""
+Parses one **kern note or rest token into (ps, quarterLength, tie, rest, fermata)
+"""
+def _kern_note(token):
+    match = re.search(r'(\d+)(\.*)', token)
+    grace = 'q' in token or 'Q' in token
+    if not match and not grace:
+        raise UnsupportedScore('no duration in kern token %r' % token)
+    ql = 0.0
+    if match and not grace:
+        recip = int(match.group(1))
+        ql = 8.0 if recip == 0 else 4.0 / recip
+        ql *= 2 - 0.5 ** len(match.group(2))
+
+    tie = NO_TIE
+    if '[' in token:
+        tie = TIE_START
+    elif '_' in token:
+        tie = TIE_CONTINUE
+    elif ']' in token:
+        tie = TIE_STOP
+    fermata = ';' in token
+
+    if 'r' in token:
+        return (np.nan, ql, tie, True, fermata)
+    letters = re.search(r'([a-gA-G])\1*', token)
+    if not letters:
+        raise UnsupportedScore('no pitch in kern token %r' % token)
+    letter = letters.group(0)
+    if letter[0].islower():
+        ps = 60 + STEPS[letter[0]] + 12 * (len(letter) - 1)
+    else:
+        ps = 48 + STEPS[letter[0].lower()] - 12 * (len(letter) - 1)
+    ps += token.count('#') - token.count('-')
+    return (float(ps), ql, tie, False, fermata)
+
+
+def _kern_key_sharps(token):
+    if token.startswith('*k['):
+        accidentals = re.findall(r'[a-g](#+|-+)', token)
+        return sum(len(a) if a[0] == '#' else -len(a) for a in accidentals)
+    match = re.match(r'\*([a-gA-G])([#-]?):$', token)
+    if match:
+        pc = (STEPS[match.group(1).lower()] + {'#': 1, '-': -1, '': 0}[match.group(2)]) % 12
+        if match.group(1).islower():
+            pc = (pc + 3) % 12 #relative major
+        return MAJOR_KEY_SHARPS[pc]
+    return None
+
+
+"""
+Reads a monophonic **kern file. Raises UnsupportedScore for anything with more than one spine,
+spine splits or chords, which should go through music21 instead
+"""
+def read_kern(path):
+    notes = []
+    meter, key_sharps = None, None
+    metadata = []
+    part_names = []
+    with open(path, encoding='latin-1') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line:
+                continue
+            if line.startswith('!!!'):
+                name, _, value = line[3:].partition(':')
+                metadata.append((HUMDRUM_RECORDS.get(name, 'humdrum:' + name), value.strip()))
+                continue
+            if line.startswith('!'):
+                continue
+            if '\t' in line or ' ' in line:
+                raise UnsupportedScore('%s has more than one spine or chords' % path)
+            if line.startswith('*'):
+                if line in ('*^', '*v', '*+', '*x'):
+                    raise UnsupportedScore('%s splits or joins spines' % path)
+                if line.startswith('**') and line != '**kern':
+                    raise UnsupportedScore('%s is not a **kern spine' % path)
+                if line.startswith('*M') and meter is None:
+                    match = re.match(r'\*M(\d+)/(\d+)$', line)
+                    if match:
+                        meter = (int(match.group(1)), int(match.group(2)))
+                elif line.startswith('*I') and not line.startswith('*IC'):
+                    code = line[2:]
+                    if code not in HUMDRUM_INSTRUMENTS:
+                        raise UnsupportedScore('%s uses instrument %s' % (path, code))
+                    part_names.append(HUMDRUM_INSTRUMENTS[code])
+                elif key_sharps is None:
+                    key_sharps = _kern_key_sharps(line)
+                continue
+            if line.startswith('=') or line == '.':
+                continue
+            notes.append(_kern_note(line))
+    return _melody(notes, meter=meter, key_sharps=key_sharps, metadata=tuple(sorted(metadata)), part_names=part_names[:1] or [None])
+
+
+"""
+Melody of the first part of a music21 score, for formats the fast reader does not handle.
+Chords are reduced to their highest note
+"""
+def melody_from_score(score):
+    from music21 import chord, meter, key
+
+    part = score.parts[0] if len(score.parts) else score
+    ts = next(iter(part.recurse().getElementsByClass(meter.TimeSignature)), None)
+    ks = next(iter(part.recurse().getElementsByClass(key.KeySignature)), None)
+    ties = {'start': TIE_START, 'continue': TIE_CONTINUE, 'stop': TIE_STOP}
+    notes = []
+    for n in part.recurse().notesAndRests:
+        if isinstance(n, chord.Chord):
+            n = max(n)
+        tie = ties.get(n.tie.type, NO_TIE) if n.tie else NO_TIE
+        fermata = len(n.expressions) != 0 and 'fermata' == n.expressions[0].name
+        notes.append((np.nan if n.isRest else n.pitch.ps, float(n.quarterLength), tie, n.isRest, fermata))
+    return _melody(
+        notes,
+        meter=(ts.numerator, ts.denominator) if ts is not None else None,
+        key_sharps=ks.sharps if ks is not None else None,
+        metadata=score.metadata.all() if score.metadata is not None else (),
+        part_names=[p.partName for p in score.parts],
+    )
+
+
+"""
+Reads a score with the fast reader, or returns None if its format needs music21
+"""
+def read_melody(path):
+    suffix = Path(path).suffix
+    try:
+        if suffix == '.krn':
+            return read_kern(path)
+    except UnsupportedScore:
+        return None
+    return None
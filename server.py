@@ -0,0 +1,196 @@
+import argparse
+import asyncio
+import json
+import re
+import uuid
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+import instrumentation
+from preferences import apply_feedback, top_k
+from similarity_store import TOMBSTONE, load_similarity_store
+
+SIMILARITY_STORE = 'all_pairs_similarity.sim'
+MAX_BATCH = 4096 #feedback events applied in one vectorized update
+BATCH_WINDOW = 0.002 #seconds to wait for more feedback before applying a batch
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        super(HTTPError, self).__init__(message)
+        self.status = status
+
+
+"""
+Local recommendation service. Every session has its own row in one (sessions x songs) preference matrix,
+and all sessions read the same memory-mapped similarity matrix.
+Feedback from all sessions is queued and applied as one batched update per tick
+"""
+class RecommendationServer(object):
+
+    def __init__(self, store_path=SIMILARITY_STORE, capacity=1024):
+        self.names, self.similarity = load_similarity_store(store_path)
+        self.name_map = {name: i for i, name in enumerate(self.names) if name != TOMBSTONE}
+        self.live_names = list(self.name_map)
+        self.removed = [i for i, name in enumerate(self.names) if name == TOMBSTONE]
+        self.prefs = np.zeros((capacity, len(self.names)), dtype=np.float32)
+        self.free_rows = list(range(capacity - 1, -1, -1))
+        self.sessions = dict() #session id -> row in self.prefs
+        self.queue = None
+
+    """
+    Starts a session on a random song, growing the preference matrix when it is full
+    """
+    def start_session(self):
+        if not self.free_rows:
+            capacity = len(self.prefs)
+            self.prefs = np.concatenate([self.prefs, np.zeros_like(self.prefs)])
+            self.free_rows = list(range(2 * capacity - 1, capacity - 1, -1))
+        row = self.free_rows.pop()
+        self.prefs[row] = 0
+        self.prefs[row, self.removed] = -np.inf
+        session = uuid.uuid4().hex
+        self.sessions[session] = row
+        return session, self.live_names[np.random.randint(len(self.live_names))]
+
+    def end_session(self, session):
+        self.free_rows.append(self.sessions.pop(session))
+
+    def recommendations(self, session, k):
+        return [self.names[t] for t in top_k(self.prefs, [self.sessions[session]], k)[0]]
+
+    """
+    Queues one piece of feedback and waits until the batch it lands in has been applied
+    """
+    async def feedback(self, session, song, liked, k):
+        with instrumentation.timed('recommend.feedback'):
+            done = asyncio.get_running_loop().create_future()
+            await self.queue.put((session, self.name_map[song], liked, k, done))
+            return await done
+
+    """
+    Applies queued feedback in batches: waits for the first event, gathers whatever else arrives
+    within BATCH_WINDOW, then updates every affected session at once and answers them all
+    """
+    async def apply_batches(self):
+        while True:
+            batch = [await self.queue.get()]
+            await asyncio.sleep(BATCH_WINDOW)
+            while len(batch) < MAX_BATCH and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            for event in batch:
+                if event[0] not in self.sessions: #ended while its feedback was queued
+                    event[4].set_exception(HTTPError(HTTPStatus.NOT_FOUND, 'no such session'))
+            batch = [event for event in batch if event[0] in self.sessions]
+            if not batch:
+                continue
+            try:
+                rows = [self.sessions[event[0]] for event in batch]
+                with instrumentation.timed('recommend.batch'):
+                    apply_feedback(self.prefs, rows, [event[1] for event in batch], [event[2] for event in batch], self.similarity)
+                    top = top_k(self.prefs, rows, max(event[3] for event in batch))
+                instrumentation.count('recommend.events', len(batch))
+            except Exception as e:
+                for event in batch:
+                    event[4].set_exception(e)
+                continue
+            for (session, _, _, k, done), songs in zip(batch, top):
+                done.set_result([self.names[t] for t in songs[:k]])
+
+    async def route(self, method, target, body):
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        try:
+            k = int(query.get('k', ['3'])[0])
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, 'k must be a number')
+        if k < 1:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, 'k must be at least 1')
+        k = min(k, len(self.live_names)) #never more songs than there are, so removed ones are never recommended
+        if url.path == '/metrics' and method == 'GET':
+            return HTTPStatus.OK, instrumentation.METRICS.to_prometheus()
+        if url.path == '/sessions' and method == 'POST':
+            session, song = self.start_session()
+            return HTTPStatus.CREATED, {'session': session, 'song': song}
+        match = re.fullmatch(r'/sessions/(\w+)(/\w+)?', url.path)
+        if not match:
+            raise HTTPError(HTTPStatus.NOT_FOUND, 'no such endpoint')
+        session, action = match.groups()
+        if session not in self.sessions:
+            raise HTTPError(HTTPStatus.NOT_FOUND, 'no such session')
+        if action is None and method == 'DELETE':
+            self.end_session(session)
+            return HTTPStatus.OK, {}
+        if action == '/recommendations' and method == 'GET':
+            return HTTPStatus.OK, {'recommendations': self.recommendations(session, k)}
+        if action == '/feedback' and method == 'POST':
+            try:
+                data = json.loads(body)
+                song, liked = data['song'], bool(data.get('liked', True))
+            except (ValueError, KeyError, TypeError):
+                raise HTTPError(HTTPStatus.BAD_REQUEST, 'expected {"song": name, "liked": true/false}')
+            if song not in self.name_map:
+                raise HTTPError(HTTPStatus.NOT_FOUND, 'no such song')
+            return HTTPStatus.OK, {'recommendations': await self.feedback(session, song, liked, k)}
+        raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED, 'method not allowed')
+
+    """
+    Serves HTTP/1.1 requests on one connection until the client closes it
+    """
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                try:
+                    status, payload = await self.route(method, target, body)
+                except HTTPError as e:
+                    status, payload = e.status, {'error': str(e)}
+                if isinstance(payload, str): #metrics, as Prometheus text
+                    data, content_type = payload.encode('utf-8'), b'text/plain; version=0.0.4'
+                else:
+                    data, content_type = json.dumps(payload).encode('utf-8'), b'application/json'
+                writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n' % (status.value, status.phrase.encode('latin-1'), content_type, len(data)) + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(self.apply_batches())
+        server = await asyncio.start_server(self.handle_connection, host, port, backlog=4096)
+        print('serving %d songs on http://%s:%d' % (len(self.names), host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serves recommendations over HTTP')
+    parser.add_argument('--store', default=SIMILARITY_STORE)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--metrics', action='store_true', help='record latencies and serve them at GET /metrics')
+    args = parser.parse_args()
+    instrumentation.enable(args.metrics or instrumentation.enabled)
+
+    asyncio.run(RecommendationServer(args.store).serve(args.host, args.port))
@@ -0,0 +1,234 @@
+import argparse
+import json
+import os
+import pickle
+import socket
+import time
+from multiprocessing import Process
+from pathlib import Path
+
+import numpy as np
+
+from build_features import STORE_DIR, feature_path, load_feature_index
+
+"""
+All-pairs similarity split into tiles that workers score independently.
+The pieces are cut into blocks of tile_size and tile (i, j) holds the scores of block i against block j;
+the matrix is symmetric, so only tiles with i <= j are scored. Everything lives in one tile directory,
+which can be on a filesystem shared between machines:
+    plan.json    the pieces in order with the content hash of each, the tile size and the weight profile
+    i_j.claim    created exclusively by the worker that takes tile (i, j), with its host, pid and start time
+    i_j.npy      the finished tile, written to a temporary file and renamed into place
+Workers only read the feature store and coordinate through these files alone, so no other service is needed
+"""
+
+TILE_DIR = 'similarity_tiles'
+TILE_SIZE = 1024
+
+
+def tile_name(tile):
+    return '%d_%d' % tile
+
+
+"""
+Every tile on or above the diagonal for n pieces
+"""
+def all_tiles(n, tile_size):
+    blocks = (n + tile_size - 1) // tile_size
+    return [(i, j) for i in range(blocks) for j in range(i, blocks)]
+
+
+def load_plan(tile_dir):
+    with open(Path(tile_dir) / 'plan.json') as f:
+        return json.load(f)
+
+
+"""
+Writes the plan for scoring every piece in a feature store with a weight profile into tile_dir.
+Planning again with the same pieces, tile size and weights keeps the tiles already done; anything else needs a fresh directory
+"""
+def plan_tiles(tile_dir, feature_dir=STORE_DIR, tile_size=TILE_SIZE, weights=None):
+    from functions import weight_list, weight_profile
+
+    index = load_feature_index(feature_dir)
+    paths = sorted(index)
+    plan = {'tile_size': tile_size, 'paths': paths, 'digests': [index[path] for path in paths],
+            'weights': weight_profile(weight_list(weights))}
+    Path(tile_dir).mkdir(parents=True, exist_ok=True)
+    if (Path(tile_dir) / 'plan.json').exists():
+        if load_plan(tile_dir) != plan:
+            raise ValueError('%s already holds tiles for other pieces, another tile size or other weights' % tile_dir)
+        return plan
+    tmp = Path(tile_dir) / ('plan.json.tmp%d' % os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(plan, f, indent=0)
+    os.replace(tmp, Path(tile_dir) / 'plan.json')
+    return plan
+
+
+"""
+Takes a tile for this process. Creating the claim file with O_EXCL succeeds for exactly one worker,
+also over NFS (v3 and later), so no two workers ever score the same tile
+"""
+def claim_tile(tile_dir, tile):
+    try:
+        fd = os.open(Path(tile_dir) / (tile_name(tile) + '.claim'), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}, f)
+    return True
+
+
+"""
+Which tiles are done, which are claimed but not done (with how long ago they were claimed) and which are still free
+"""
+def tile_status(tile_dir):
+    plan = load_plan(tile_dir)
+    done, claimed, pending = [], dict(), []
+    now = time.time()
+    for tile in all_tiles(len(plan['paths']), plan['tile_size']):
+        base = Path(tile_dir) / tile_name(tile)
+        if base.with_suffix('.npy').exists():
+            done.append(tile)
+        elif base.with_suffix('.claim').exists():
+            try:
+                claimed[tile] = now - base.with_suffix('.claim').stat().st_mtime
+            except FileNotFoundError: #released in the meantime
+                pending.append(tile)
+        else:
+            pending.append(tile)
+    return done, claimed, pending
+
+
+"""
+Frees tiles claimed more than older_than seconds ago that are still not done, e.g. because their worker died
+"""
+def release_stale_claims(tile_dir, older_than):
+    _, claimed, _ = tile_status(tile_dir)
+    released = [tile for tile, age in claimed.items() if age > older_than]
+    for tile in released:
+        try:
+            os.remove(Path(tile_dir) / (tile_name(tile) + '.claim'))
+        except FileNotFoundError:
+            pass
+    return released
+
+
+"""
+Scores free tiles until none are left. Returns how many tiles this worker scored.
+feature_dir is where this machine sees the feature store the plan was made from
+"""
+def work(tile_dir, feature_dir=STORE_DIR):
+    from similarity_matrix import pack_features, similarity_block
+
+    plan = load_plan(tile_dir)
+    features = []
+    for digest in plan['digests']:
+        with open(feature_path(feature_dir, digest), 'rb') as handle:
+            features.append(pickle.load(handle))
+    packed = pack_features(features)
+    n, tile_size = len(features), plan['tile_size']
+
+    scored = 0
+    for tile in all_tiles(n, tile_size):
+        out = Path(tile_dir) / (tile_name(tile) + '.npy')
+        if out.exists() or not claim_tile(tile_dir, tile):
+            continue
+        start = time.time()
+        rows = np.arange(tile[0] * tile_size, min((tile[0] + 1) * tile_size, n))
+        cols = np.arange(tile[1] * tile_size, min((tile[1] + 1) * tile_size, n))
+        block = similarity_block(packed, rows, cols, plan.get('weights')).astype(np.float32) #plans from before weights used the defaults
+        tmp = Path(tile_dir) / ('%s.%s.%d.tmp' % (tile_name(tile), socket.gethostname(), os.getpid()))
+        with open(tmp, 'wb') as f:
+            np.save(f, block)
+        os.replace(tmp, out)
+        scored += 1
+        print('[%s:%d] tile %s in %.1fs' % (socket.gethostname(), os.getpid(), tile_name(tile), time.time() - start))
+    return scored
+
+
+"""
+Merges the finished tiles into a similarity store and, if topk_path is given, builds its top-k index.
+Also writes the digests sidecar, so update_corpus.py can keep the store up to date afterwards
+"""
+def merge_tiles(tile_dir, output, topk_path=None, dtype=np.float32):
+    from functions import weight_list
+    from similarity_store import create_similarity_store
+    from update_corpus import save_store_digests, digests_by_name
+
+    plan = load_plan(tile_dir)
+    done, claimed, pending = tile_status(tile_dir)
+    if claimed or pending:
+        raise ValueError('%d of %d tiles are not done yet' % (len(claimed) + len(pending), len(done) + len(claimed) + len(pending)))
+    tile_size = plan['tile_size']
+    matrix = create_similarity_store(output, [Path(path).name for path in plan['paths']], dtype, weights=weight_list(plan.get('weights')))
+    for i, j in done:
+        block = np.load(Path(tile_dir) / (tile_name((i, j)) + '.npy'))
+        rows, cols = slice(i * tile_size, i * tile_size + block.shape[0]), slice(j * tile_size, j * tile_size + block.shape[1])
+        matrix[rows, cols] = block
+        matrix[cols, rows] = block.T
+    matrix.flush()
+    save_store_digests(output, digests_by_name(dict(zip(plan['paths'], plan['digests']))))
+
+    if topk_path:
+        from topk_index import build_topk_index, save_topk_index
+        neighbours, scores = build_topk_index(matrix)
+        save_topk_index(topk_path, [Path(path).name for path in plan['paths']], neighbours, scores)
+    return matrix
+
+
+"""
+Plans, scores every tile with a pool of local worker processes and merges, all on this machine
+"""
+def run_local(tile_dir, output, feature_dir=STORE_DIR, tile_size=TILE_SIZE, processes=None, topk_path=None, dtype=np.float32, weights=None):
+    plan_tiles(tile_dir, feature_dir, tile_size, weights)
+    workers = [Process(target=work, args=(tile_dir, feature_dir)) for _ in range(processes or os.cpu_count())]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return merge_tiles(tile_dir, output, topk_path, dtype)
+
+
+if __name__ == "__main__":
+    from topk_index import TOPK_INDEX
+
+    parser = argparse.ArgumentParser(description='Computes the similarity store in tiles, with workers on one or several machines sharing a tile directory')
+    parser.add_argument('command', choices=['plan', 'work', 'status', 'merge', 'run'],
+                        help='plan the tiles, score tiles as a worker, show progress, merge finished tiles, or do it all with local processes')
+    parser.add_argument('--tiles', default=TILE_DIR, help='tile directory, shared by every worker')
+    parser.add_argument('--store', default=STORE_DIR, help='feature store, as this machine sees it')
+    parser.add_argument('--tile-size', type=int, default=TILE_SIZE)
+    parser.add_argument('-j', '--processes', type=int, default=None, help='worker processes for run (default: all cores)')
+    parser.add_argument('--release-after', type=float, default=None, help='free tiles claimed this many seconds ago that are still not done')
+    parser.add_argument('-o', '--output', default='all_pairs_similarity.sim')
+    parser.add_argument('--topk', default=TOPK_INDEX, help='top-k index to build when merging (empty to skip)')
+    parser.add_argument('--float16', action='store_true', help='store scores as float16 instead of float32')
+    parser.add_argument('--weights', default=None, help='JSON weight profile to plan the scores with, {component: weight}')
+    args = parser.parse_args()
+    dtype = np.float16 if args.float16 else np.float32
+    weights = None
+    if args.weights:
+        from functions import load_weights
+        weights = load_weights(args.weights)
+
+    if args.release_after is not None:
+        for tile in release_stale_claims(args.tiles, args.release_after):
+            print('released tile %s' % tile_name(tile))
+    if args.command == 'plan':
+        plan = plan_tiles(args.tiles, args.store, args.tile_size, weights)
+        print('%d tiles for %d pieces in %s' % (len(all_tiles(len(plan['paths']), plan['tile_size'])), len(plan['paths']), args.tiles))
+    elif args.command == 'work':
+        print('scored %d tiles' % work(args.tiles, args.store))
+    elif args.command == 'status':
+        done, claimed, pending = tile_status(args.tiles)
+        print('%d done, %d in progress, %d to do' % (len(done), len(claimed), len(pending)))
+        for tile, age in sorted(claimed.items()):
+            print('  %s claimed %ds ago' % (tile_name(tile), age))
+    elif args.command == 'merge':
+        merge_tiles(args.tiles, args.output, args.topk, dtype)
+        print('wrote %s' % args.output)
+    else:
+        run_local(args.tiles, args.output, args.store, args.tile_size, args.processes, args.topk, dtype, weights)
+        print('wrote %s' % args.output)
@@ -0,0 +1,414 @@
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+import instrumentation
+from functions import SIMILARITY_COMPONENTS, get_composer, composers_match, weight_list, bound_weight_list
+from topk_index import topk_entries
+
+
+"""
+Packs a list of feature records into NumPy arrays, one row per piece.
+Features similarity() only tests for equality (meter, instrumentation, composer) become integer ids
+"""
+def pack_features(features: list):
+    n = len(features)
+
+    composers = [get_composer(d['metadata']) for d in features]
+    unique_composers = sorted(set(c for c in composers if c is not None))
+    composer_ids = {c: i for i, c in enumerate(unique_composers)}
+    composer_table = np.zeros((len(unique_composers) + 1, len(unique_composers) + 1), dtype=bool) #last id means no composer
+    for c1, i in composer_ids.items():
+        for c2, j in composer_ids.items():
+            composer_table[i, j] = composers_match(c1, c2)
+
+    meter_ids, instrument_ids = dict(), dict()
+    meters = np.array([meter_ids.setdefault(d['musical_attr'][0], len(meter_ids)) for d in features], dtype=np.int64)
+    instruments = np.array([instrument_ids.setdefault(frozenset(d['musical_attr'][3]), len(instrument_ids)) for d in features], dtype=np.int64)
+
+    #pieces similarity() can't score (no phrases or no notes) are packed as nan so their scores come out as nan
+    phrase_lengths = np.array([d['phrase_lengths'] if d['phrase_lengths'] is not None else np.nan for d in features], dtype=np.float64)
+    nonharmonics = np.array([d['nonharmonics'] if d['nonharmonics'] is not None else (np.nan, np.nan) for d in features], dtype=np.float64).reshape(n, 2)
+
+    intervals = np.array([d['intervals'] for d in features], dtype=np.float64).reshape(n, 25)
+    interval_norms = np.zeros(n)
+    for k in range(25):
+        interval_norms += intervals[:, k] * intervals[:, k]
+
+    #arch profiles, grouped by phrase length: which pieces have one and a (pieces x length) array of them
+    arches = dict()
+    for i, d in enumerate(features):
+        start = 0
+        for length in d['arch_lengths'].tolist():
+            arches.setdefault(length, ([], []))
+            arches[length][0].append(i)
+            arches[length][1].append(d['arch_profiles'][start:start + length])
+            start += length
+    arch_pieces = dict()
+    arch_profiles = dict()
+    arch_rows = np.full((n, max(arches, default=0) + 1), -1, dtype=np.int32) #each piece's row in arch_profiles[length], -1 if it has none
+    for length, (pieces, profiles) in arches.items():
+        arch_pieces[length] = np.array(pieces, dtype=np.int64)
+        arch_profiles[length] = np.array(profiles, dtype=np.float64)
+        arch_rows[arch_pieces[length], length] = np.arange(len(pieces))
+    #arches_below[i, l]: how many of piece i's phrase lengths from 5 up to l - 1 have an arch, i.e. count in similarity()
+    counted = arch_rows >= 0
+    counted[:, :5] = False
+    arches_below = np.zeros((n, arch_rows.shape[1] + 1), dtype=np.int32)
+    np.cumsum(counted, axis=1, out=arches_below[:, 1:])
+    #those phrase lengths, piece after piece; piece i's start at arch_offsets[i]
+    arch_offsets = np.concatenate([[0], np.cumsum(arches_below[:, -1])])
+
+    return {
+        'size': n,
+        'composers': np.array([composer_ids[c] if c is not None else len(unique_composers) for c in composers], dtype=np.int64),
+        'composer_table': composer_table,
+        'meters': meters,
+        'keys': np.array([d['musical_attr'][1] for d in features], dtype=np.int64),
+        'instruments': instruments,
+        'note_lengths': np.array([d['note_lengths'] for d in features], dtype=np.float64).reshape(n, 16),
+        'phrase_lengths': phrase_lengths,
+        'names': np.array([d['name'] for d in features], dtype=np.int64).reshape(n, 6),
+        'nonharmonics': nonharmonics,
+        'intervals': intervals,
+        'interval_norms': interval_norms,
+        'arch_pieces': arch_pieces,
+        'arch_profiles': arch_profiles,
+        'arch_rows': arch_rows,
+        'arches_below': arches_below,
+        'arch_offsets': arch_offsets,
+        'arch_lengths': np.nonzero(counted)[1],
+    }
+
+
+"""
+min/max ratio of two arrays, 1 where both are 0, like the ratios similarity() computes one pair at a time
+"""
+def _ratio(a, b):
+    low, high = np.minimum(a, b), np.maximum(a, b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(high != 0, low / high, 1)
+
+
+"""
+Every component but the melodic arch, unweighted and in the order of SIMILARITY_COMPONENTS.
+r and c are index arrays that broadcast against each other: rows[:, None] and cols[None, :] for a block,
+or two equally long arrays for single pairs. Returns the components and the phrase lengths of r and c
+"""
+def _component_scores(packed, r, c):
+    components = [
+        np.where(packed['composer_table'][packed['composers'][r], packed['composers'][c]], 1.0, 0.0),
+        packed['meters'][r] == packed['meters'][c],
+        packed['keys'][r] == packed['keys'][c],
+        packed['instruments'][r] == packed['instruments'][c],
+    ]
+
+    #note lengths, summed in order over the 16 lengths
+    n1, n2 = packed['note_lengths'][r], packed['note_lengths'][c]
+    note_length_sum = _ratio(n1[..., 0], n2[..., 0])
+    for i in range(1, 16):
+        note_length_sum = note_length_sum + _ratio(n1[..., i], n2[..., i])
+    components.append(note_length_sum / 16.0)
+
+    pl1, pl2 = packed['phrase_lengths'][r], packed['phrase_lengths'][c]
+    components.append(_ratio(pl1, pl2))
+
+    p1, p2 = packed['names'][r], packed['names'][c]
+    matches = ((p1 == 1) & (p2 == 1)).sum(axis=-1)
+    total = (~((p1 == 0) & (p2 == 0))).sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        components.append(np.where(total != 0, matches / total, 0))
+
+    nn1, nn2 = packed['nonharmonics'][r], packed['nonharmonics'][c]
+    components.append(_ratio(nn1[..., 0], nn2[..., 0]))
+    components.append(_ratio(nn1[..., 1], nn2[..., 1]))
+
+    #interval cosine, summed bin by bin like interval_cosine()
+    i1, i2 = packed['intervals'][r], packed['intervals'][c]
+    dot = np.zeros(np.broadcast_shapes(np.shape(r), np.shape(c)))
+    for k in range(25):
+        dot += i1[..., k] * i2[..., k]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        components.append(dot / np.sqrt(packed['interval_norms'][r] * packed['interval_norms'][c]))
+    return components, pl1, pl2
+
+
+"""
+Every component but the melodic arch, weighted and summed in the same order as similarity(); at most 14 per pair
+with the default weights. Returns the sums and the phrase lengths of r and c
+"""
+def _base_scores(packed, r, c, weights=None):
+    components, pl1, pl2 = _component_scores(packed, r, c)
+    score = np.zeros(np.broadcast_shapes(np.shape(r), np.shape(c)))
+    for component, weight in zip(components, weight_list(weights)):
+        score += weight * component
+    return score, pl1, pl2
+
+
+"""
+The most every component but the melodic arch can add up to, and the weight of each arch term
+"""
+def _base_max(weights=None):
+    weights = weight_list(weights)
+    return sum(weights[:-1]), weights[-1]
+
+
+"""
+Phrase lengths below which melodic arches are compared, for every pair
+"""
+def _arch_limit(pl1, pl2):
+    with np.errstate(invalid='ignore'):
+        return np.nan_to_num((pl1 + pl2) / 2.0 + 5).astype(np.int64)
+
+
+"""
+Melodic arch terms, one phrase length at a time for the pairs where both pieces have phrases of that length.
+Returns their (rows x cols) sums and counts
+"""
+def _arch_scores(packed, rows, cols, limit):
+    arch_sum = np.zeros((len(rows), len(cols)))
+    arch_count = np.zeros((len(rows), len(cols)), dtype=np.int64)
+    row_pos = np.full(packed['size'], -1, dtype=np.int64)
+    row_pos[rows] = np.arange(len(rows))
+    col_pos = np.full(packed['size'], -1, dtype=np.int64)
+    col_pos[cols] = np.arange(len(cols))
+    max_limit = limit.max() if limit.size else 0
+    for length in sorted(packed['arch_pieces']):
+        if length < 5 or length >= max_limit:
+            continue
+        pieces, profiles = packed['arch_pieces'][length], packed['arch_profiles'][length]
+        in_rows = row_pos[pieces] != -1
+        in_cols = col_pos[pieces] != -1
+        if not in_rows.any() or not in_cols.any():
+            continue
+        r, c = row_pos[pieces[in_rows]], col_pos[pieces[in_cols]]
+        a1, a2 = profiles[in_rows][:, None, :], profiles[in_cols][None, :, :]
+        sim = np.zeros((len(r), len(c)))
+        for n in range(length):
+            sim += np.where(np.maximum(a1[:, :, n], a2[:, :, n]) != 0, np.abs(a1[:, :, n] - a2[:, :, n]), 0)
+        sim /= length #average difference
+        with np.errstate(divide='ignore'):
+            term = np.where(sim > 0, np.minimum(1.0, 1.0 / sim), 1)
+        counted = length < limit[r[:, None], c[None, :]]
+        arch_sum[r[:, None], c[None, :]] += np.where(counted, term, 0)
+        arch_count[r[:, None], c[None, :]] += counted
+    return arch_sum, arch_count
+
+
+"""
+Similarity scores between the pieces at index arrays rows and cols of packed features, as a (rows x cols) array.
+Every component is accumulated in the same order as similarity(), so the scores are identical to it
+"""
+@instrumentation.instrumented('similarity.block')
+def similarity_block(packed, rows, cols, weights=None):
+    rows, cols = np.asarray(rows), np.asarray(cols)
+    instrumentation.count('similarity.pairs', len(rows) * len(cols))
+    score, pl1, pl2 = _base_scores(packed, rows[:, None], cols[None, :], weights)
+    arch_sum, arch_count = _arch_scores(packed, rows, cols, _arch_limit(pl1, pl2))
+    base_max, arch_weight = _base_max(weights)
+    score += arch_weight * arch_sum
+    return score / (base_max + arch_weight * arch_count)
+
+
+"""
+The unweighted components of every pair of rows and cols, as a (components + 1) x rows x cols array: one layer per
+component in the order of SIMILARITY_COMPONENTS, with the sum of the melodic arch terms, and the number of arch terms last.
+Weighting and adding up the layers like similarity_block() does gives the same scores up to rounding
+"""
+def component_block(packed, rows, cols):
+    rows, cols = np.asarray(rows), np.asarray(cols)
+    out = np.empty((len(SIMILARITY_COMPONENTS) + 1, len(rows), len(cols)))
+    components, pl1, pl2 = _component_scores(packed, rows[:, None], cols[None, :])
+    for layer, component in enumerate(components):
+        out[layer] = component
+    out[-2], out[-1] = _arch_scores(packed, rows, cols, _arch_limit(pl1, pl2))
+    return out
+
+
+"""
+Melodic arch terms for single pairs of pieces r[i], c[i], accumulated like _arch_scores() so the sums are the same.
+Returns their sums and counts, one per pair
+"""
+def _pair_arch_scores(packed, r, c, limit):
+    arch_sum = np.zeros(len(r))
+    arch_count = np.zeros(len(r), dtype=np.int64)
+    #one entry for every phrase length of r's pieces that has an arch, kept if c's piece has one too and it counts
+    counts = packed['arch_offsets'][r + 1] - packed['arch_offsets'][r]
+    pair = np.repeat(np.arange(len(r)), counts)
+    entry = np.arange(len(pair)) - np.repeat(np.cumsum(counts) - counts, counts)
+    lengths = packed['arch_lengths'][packed['arch_offsets'][r][pair] + entry]
+    keep = (lengths < limit[pair]) & (packed['arch_rows'][c[pair], lengths] >= 0)
+    pair, lengths = pair[keep], lengths[keep]
+    order = np.argsort(lengths, kind='stable')
+    pair, lengths = pair[order], lengths[order]
+    starts = np.flatnonzero(np.diff(lengths, prepend=-1))
+    for start, end in zip(starts, np.append(starts[1:], len(lengths))):
+        length, pairs = lengths[start], pair[start:end]
+        profiles = packed['arch_profiles'][length]
+        a1, a2 = profiles[packed['arch_rows'][r[pairs], length]], profiles[packed['arch_rows'][c[pairs], length]]
+        #cumsum adds the differences one after the other, as the loop in _arch_scores does
+        sim = np.cumsum(np.where(np.maximum(a1, a2) != 0, np.abs(a1 - a2), 0), axis=1)[:, -1] / length
+        with np.errstate(divide='ignore'):
+            arch_sum[pairs] += np.where(sim > 0, np.minimum(1.0, 1.0 / sim), 1)
+        arch_count[pairs] += 1
+    return arch_sum, arch_count
+
+
+"""
+Upper bounds on the scores of the pairs rows x cols that skip the two costly components, note lengths and
+melodic arches. The note lengths count as their most, 1, and so does every arch term the pair could have:
+at most the fewer of the two pieces' arch counts below the pair's limit, m. A pair whose other components
+add up to b then scores at most (b + w_notes + w_arch * m)/(base + w_arch * m), with w the weights of
+bound_weight_list(weights) and base the most every component but the arch adds up to. The interval cosine comes
+from one matrix product here, which can round differently from the bin by bin sum, so compare against the bounds
+with some slack. Returns the bounds and the pairs' arch limits
+"""
+def _upper_bounds(packed, rows, cols, weights=None):
+    r, c = rows[:, None], cols[None, :]
+    pl1, pl2 = packed['phrase_lengths'][r], packed['phrase_lengths'][c]
+    p1, p2 = packed['names'][r], packed['names'][c]
+    matches = ((p1 == 1) & (p2 == 1)).sum(axis=-1)
+    total = (~((p1 == 0) & (p2 == 0))).sum(axis=-1)
+    nn1, nn2 = packed['nonharmonics'][r], packed['nonharmonics'][c]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        components = [
+            np.where(packed['composer_table'][packed['composers'][r], packed['composers'][c]], 1.0, 0.0),
+            packed['meters'][r] == packed['meters'][c],
+            packed['keys'][r] == packed['keys'][c],
+            packed['instruments'][r] == packed['instruments'][c],
+            1, #note lengths, at their most
+            _ratio(pl1, pl2),
+            np.where(total != 0, matches / total, 0),
+            _ratio(nn1[..., 0], nn2[..., 0]),
+            _ratio(nn1[..., 1], nn2[..., 1]),
+            (packed['intervals'][rows] @ packed['intervals'][cols].T) / np.sqrt(packed['interval_norms'][r] * packed['interval_norms'][c]),
+        ]
+    weights = bound_weight_list(weights)
+    score = np.zeros((len(rows), len(cols)))
+    for component, weight in zip(components, weights):
+        score += weight * component
+
+    below = packed['arches_below']
+    limit = np.minimum(_arch_limit(pl1, pl2), below.shape[1] - 1)
+    max_arches = np.minimum(below[r, limit], below[c, limit])
+    base_max, arch_weight = sum(weights[:-1]), weights[-1]
+    return (score + arch_weight * max_arches) / (base_max + arch_weight * max_arches), limit
+
+
+"""
+Exact scores of single pairs r[i], c[i], the same as similarity_block() gives them; -inf where it gives nan
+"""
+def _pair_scores(packed, r, c, limit=None, weights=None):
+    score, pl1, pl2 = _base_scores(packed, r, c, weights)
+    if limit is None:
+        limit = _arch_limit(pl1, pl2)
+    arch_sum, arch_count = _pair_arch_scores(packed, r, c, limit)
+    base_max, arch_weight = _base_max(weights)
+    score += arch_weight * arch_sum
+    return np.nan_to_num(score / (base_max + arch_weight * arch_count), nan=-np.inf)
+
+
+"""
+similarity() of the pieces at rows[i] and cols[i] of packed features for every i, e.g. candidates from an index.
+Missing scores are -inf
+"""
+@instrumentation.instrumented('similarity.pair_similarity')
+def pair_similarity(packed, rows, cols, weights=None):
+    rows, cols = np.asarray(rows), np.asarray(cols)
+    instrumentation.count('similarity.pairs_scored', len(rows))
+    return _pair_scores(packed, rows, cols, weights=weights)
+
+
+"""
+The k best-scoring cols for each of rows, as (neighbours, scores) sorted best first, in two stages.
+First every pair gets an upper bound that skips the costly components (_upper_bounds) and the seeds pairs with the
+best bounds in each row are scored exactly, which puts a floor under each row's k-th best score.
+Then only the pairs whose bound reaches that floor are scored. Pairs that are skipped can never make the
+top k, so the scores are the same as scoring every pair with weights, which must not be negative.
+exclude[i], if given, is never returned for rows[i]
+"""
+@instrumentation.instrumented('similarity.top_similar')
+def top_similar(packed, rows, cols, k, exclude=None, seeds=None, weights=None):
+    rows, cols = np.asarray(rows), np.asarray(cols)
+    k = min(k, len(cols))
+    seeds = min(seeds or 2 * k, len(cols))
+    upper, limit = _upper_bounds(packed, rows, cols, weights)
+    upper = np.nan_to_num(upper, nan=-np.inf)
+    if exclude is not None:
+        upper[cols[None, :] == np.asarray(exclude)[:, None]] = -np.inf
+
+    scores = np.full(upper.shape, -np.inf)
+    i = np.repeat(np.arange(len(rows)), seeds)
+    j = np.argpartition(-upper, seeds - 1, axis=1)[:, :seeds].ravel()
+    i, j = i[upper[i, j] > -np.inf], j[upper[i, j] > -np.inf]
+    scores[i, j] = _pair_scores(packed, rows[i], cols[j], limit[i, j], weights)
+    scored = np.zeros(upper.shape, dtype=bool)
+    scored[i, j] = True
+
+    floor = -np.partition(-scores, k - 1, axis=1)[:, k - 1]
+    i, j = np.nonzero((upper >= floor[:, None] - 1e-9) & (upper > -np.inf) & ~scored) #slack for rounding in the bounds
+    scores[i, j] = _pair_scores(packed, rows[i], cols[j], limit[i, j], weights)
+    instrumentation.count('similarity.pairs_bounded', upper.size)
+    instrumentation.count('similarity.pairs_scored', int(scored.sum()) + len(i))
+
+    best, best_scores = topk_entries(scores, k)
+    return cols[best], best_scores
+
+
+"""
+Full similarity matrix between all pieces, computed in blocks of block_size rows so memory stays bounded.
+Only blocks on or above the diagonal are scored; the matrix is symmetric so the rest is mirrored.
+Pass out to fill an existing (n x n) array, e.g. a memory-mapped one, and weights for a weight profile
+"""
+def similarity_matrix(features: list, block_size=256, out=None, weights=None):
+    packed = pack_features(features)
+    n = packed['size']
+    if out is None:
+        out = np.empty((n, n))
+    for start in range(0, n, block_size):
+        rows = np.arange(start, min(start + block_size, n))
+        for col_start in range(start, n, block_size):
+            cols = np.arange(col_start, min(col_start + block_size, n))
+            block = similarity_block(packed, rows, cols, weights)
+            out[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1] = block
+            out[cols[0]:cols[-1] + 1, rows[0]:rows[-1] + 1] = block.T
+    return out
+
+
+if __name__ == "__main__":
+    from build_features import STORE_DIR, load_feature_store
+    from similarity_store import create_similarity_store
+
+    parser = argparse.ArgumentParser(description='Computes the similarity of every pair of scores in the feature store')
+    parser.add_argument('--store', default=STORE_DIR)
+    parser.add_argument('--notes', default=None, help='extract features from this note table instead of reading the feature store')
+    parser.add_argument('-o', '--output', default='all_pairs_similarity.sim')
+    parser.add_argument('--block-size', type=int, default=256)
+    parser.add_argument('--float16', action='store_true', help='store scores as float16 instead of float32')
+    parser.add_argument('--weights', default=None, help='JSON weight profile, {component: weight}, for the components it names')
+    args = parser.parse_args()
+    weights = None
+    if args.weights:
+        from functions import load_weights
+        weights = load_weights(args.weights)
+
+    print('loading features...')
+    if args.notes:
+        from functions import note_table_features
+        from note_table import NoteTable
+        table = NoteTable.load(args.notes)
+        paths, features = table.names, note_table_features(table)
+    else:
+        paths, features = load_feature_store(args.store)
+
+    print('computing similarities between %d scores...' % len(paths))
+    out = create_similarity_store(args.output, [Path(path).name for path in paths], np.float16 if args.float16 else np.float32,
+                                  weights=weight_list(weights))
+    similarity_matrix(features, args.block_size, out, weights)
+    out.flush()
+    if not args.notes: #lets update_corpus.py tell which pieces changed since
+        from build_features import load_feature_index
+        from update_corpus import save_store_digests, digests_by_name
+        save_store_digests(args.output, digests_by_name(load_feature_index(args.store)))
+    print('wrote %s' % args.output)
@@ -0,0 +1,172 @@
+import argparse
+import os
+import struct
+
+import numpy as np
+
+"""
+Binary similarity store: a fixed-size header, a (capacity x capacity) matrix of float32 or float16 scores
+starting at DATA_OFFSET so it can be memory-mapped directly, then the piece names as UTF-8, one per line.
+Only the first count rows and columns are in use; capacity leaves room to add pieces without rewriting the file.
+A deleted piece keeps its slot as a tombstone: its name is empty and its row and column are nan.
+Right after the header come the similarity weights the scores were computed with (functions.weight_list), as a count
+and that many float64s, so the store is never extended with scores of another weight profile. Stores written before
+the weights were recorded have a count of 0 there
+"""
+MAGIC = b'SIMSTORE'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQQQQ') #magic, version, dtype code, count, capacity, names offset, names length
+WEIGHT_COUNT = struct.Struct('<I')
+DATA_OFFSET = 4096
+DTYPES = {0: np.float32, 1: np.float16}
+TOMBSTONE = ''
+
+
+def _dtype_code(dtype):
+    for code, d in DTYPES.items():
+        if np.dtype(d) == np.dtype(dtype):
+            return code
+    raise ValueError('similarity store only holds float32 or float16, not %s' % np.dtype(dtype))
+
+
+def _pack_weights(weights):
+    weights = [float(weight) for weight in weights or ()]
+    if HEADER.size + WEIGHT_COUNT.size + 8 * len(weights) > DATA_OFFSET:
+        raise ValueError('%d weights do not fit in the header of a similarity store' % len(weights))
+    return WEIGHT_COUNT.pack(len(weights)) + struct.pack('<%dd' % len(weights), *weights)
+
+
+"""
+Reads the header of a store as a dict. Its weights are None if the store does not record them
+"""
+def read_header(path):
+    with open(path, 'rb') as f:
+        header = f.read(DATA_OFFSET)
+    magic, version, dtype_code, count, capacity, names_offset, names_length = HEADER.unpack_from(header)
+    if magic != MAGIC:
+        raise ValueError('%s is not a similarity store' % path)
+    if version != VERSION:
+        raise ValueError('%s is similarity store version %d, expected %d' % (path, version, VERSION))
+    num_weights, = WEIGHT_COUNT.unpack_from(header, HEADER.size)
+    return {
+        'dtype': DTYPES[dtype_code],
+        'count': count,
+        'capacity': capacity,
+        'names_offset': names_offset,
+        'names_length': names_length,
+        'weights': struct.unpack_from('<%dd' % num_weights, header, HEADER.size + WEIGHT_COUNT.size) if num_weights else None,
+    }
+
+
+"""
+Creates an empty store for the given names, with every score set to nan, recording the weights the scores will be
+computed with (a functions.weight_list), if given.
+Returns the writable (count x count) memory-mapped matrix to fill in
+"""
+def create_similarity_store(path, names: list, dtype=np.float32, capacity=None, weights=None):
+    count = len(names)
+    capacity = max(capacity or count, count)
+    names_offset = DATA_OFFSET + capacity * capacity * np.dtype(dtype).itemsize
+    names_bytes = '\n'.join(names).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, _dtype_code(dtype), count, capacity, names_offset, len(names_bytes)))
+        f.write(_pack_weights(weights))
+        f.truncate(names_offset)
+        f.seek(names_offset)
+        f.write(names_bytes)
+    matrix = np.memmap(path, dtype=dtype, mode='r+', offset=DATA_OFFSET, shape=(capacity, capacity))[:count, :count]
+    matrix[:] = np.nan
+    return matrix
+
+
+"""
+Opens a store. Returns the piece names and the memory-mapped (count x count) similarity matrix.
+The default read-only mapping is shared between every process that opens the same file
+"""
+def load_similarity_store(path, mode='r'):
+    header = read_header(path)
+    with open(path, 'rb') as f:
+        f.seek(header['names_offset'])
+        names_bytes = f.read(header['names_length'])
+    names = names_bytes.decode('utf-8').split('\n') if header['count'] else []
+    capacity, count = header['capacity'], header['count']
+    matrix = np.memmap(path, dtype=header['dtype'], mode=mode, offset=DATA_OFFSET, shape=(capacity, capacity))[:count, :count]
+    return names, matrix
+
+
+"""
+Rewrites the names of a store in place, which also sets how many pieces are in use
+"""
+def write_similarity_store_names(path, names: list):
+    header = read_header(path)
+    if len(names) > header['capacity']:
+        raise ValueError('%d names do not fit in a store with capacity %d' % (len(names), header['capacity']))
+    names_bytes = '\n'.join(names).encode('utf-8')
+    with open(path, 'r+b') as f:
+        f.seek(header['names_offset'])
+        f.write(names_bytes)
+        f.truncate()
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, _dtype_code(header['dtype']), len(names), header['capacity'], header['names_offset'], len(names_bytes)))
+
+
+"""
+Adds pieces to the end of a store, with nan scores. Uses the spare capacity if there is enough; otherwise the
+store is copied into a new file with at least double the capacity, so growing one piece at a time stays cheap.
+Returns all the names and the writable memory-mapped matrix
+"""
+def grow_similarity_store(path, new_names: list, block_size=1024):
+    header = read_header(path)
+    names, matrix = load_similarity_store(path)
+    count = len(names) + len(new_names)
+    if count > header['capacity']:
+        tmp = '%s.tmp' % path
+        grown = create_similarity_store(tmp, names, header['dtype'], max(2 * header['capacity'], count), header['weights'])
+        for start in range(0, len(names), block_size):
+            grown[start:start + block_size] = matrix[start:start + block_size]
+        grown.flush()
+        del grown, matrix
+        os.replace(tmp, path)
+    write_similarity_store_names(path, names + list(new_names))
+    names, matrix = load_similarity_store(path, mode='r+')
+    matrix[len(names) - len(new_names):, :] = np.nan
+    matrix[:, len(names) - len(new_names):] = np.nan
+    return names, matrix
+
+
+"""
+Writes a whole similarity matrix to a new store
+"""
+def write_similarity_store(path, names: list, matrix, dtype=np.float32, weights=None):
+    out = create_similarity_store(path, names, dtype, weights=weights)
+    out[:] = matrix
+    out.flush()
+
+
+"""
+Converts a long-format name1,name2,score CSV into a store, reading it in chunks.
+Like interactive.py always did, pairs missing from the CSV are nan and a piece is fully similar to itself
+"""
+def convert_csv(csv_path, out_path, dtype=np.float32, chunksize=1000000):
+    import pandas as pd
+
+    names = sorted(set(pd.read_csv(csv_path, index_col=False, usecols=['name1'])['name1']))
+    name_map = pd.Series(np.arange(len(names)), index=names)
+    matrix = create_similarity_store(out_path, names, dtype)
+    np.fill_diagonal(matrix, 1)
+    for chunk in pd.read_csv(csv_path, index_col=False, chunksize=chunksize):
+        chunk = chunk[chunk['name1'].isin(name_map.index) & chunk['name2'].isin(name_map.index)]
+        matrix[name_map[chunk['name1']].values, name_map[chunk['name2']].values] = chunk['score'].values
+    matrix.flush()
+    return names
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Converts an all-pairs similarity CSV into a binary similarity store')
+    parser.add_argument('csv', nargs='?', default='all_pairs_similarity.csv')
+    parser.add_argument('-o', '--output', default='all_pairs_similarity.sim')
+    parser.add_argument('--float16', action='store_true', help='store scores as float16 instead of float32')
+    args = parser.parse_args()
+
+    names = convert_csv(args.csv, args.output, np.float16 if args.float16 else np.float32)
+    print('wrote %d pieces to %s' % (len(names), args.output))
@@ -1,27 +1,39 @@
 import random
+import numpy as np
 import torch
 from torch.utils.data import Dataset
 
-class SnipsDataset(Dataset):
+class WindowDataset(Dataset):
+    # every window of window_len tokens plus the token that follows it, within each piece
+    # tokens is the whole corpus as one flat sequence and piece i is tokens[offsets[i]:offsets[i + 1]]
+    # pieces, if given, restricts the windows to those pieces (e.g. a training or validation split)
     
-    def __init__(self, snips, transform=None):
-        self.inputs = []
-        self.outputs = []
-        for i, o in snips:
-            self.inputs.append(i)
-            self.outputs.append(o)
-        self.inputs = torch.Tensor(self.inputs).long()
-        self.outputs = torch.Tensor(self.outputs).long()
+    def __init__(self, tokens, offsets, window_len=30, transform=None, pieces=None):
+        self.tokens = torch.as_tensor(np.asarray(tokens, dtype=np.int64))
+        self.window_len = window_len
+        offsets = np.asarray(offsets, dtype=np.int64)
+        counts = np.maximum(np.diff(offsets) - window_len, 0)
+        if pieces is not None:
+            counts[np.setdiff1d(np.arange(len(counts)), pieces)] = 0
+        # start of every window, so that no window runs past the end of its piece
+        first = np.cumsum(counts) - counts
+        self.starts = torch.from_numpy(np.repeat(offsets[:-1], counts) + np.arange(counts.sum()) - np.repeat(first, counts))
+        # one strided view over the tokens, no window is ever copied
+        if len(self.tokens) > window_len:
+            self.windows = self.tokens.unfold(0, window_len + 1, 1)
+        else:
+            self.windows = self.tokens.new_zeros((0, window_len + 1))
         self.transform = transform
     
     def __len__(self):
-        return len(self.outputs)
+        return len(self.starts)
 
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
-        ret = (self.inputs[idx], self.outputs[idx])
+        window = self.windows[self.starts[idx]]
+        ret = (window[..., :-1], window[..., -1])
         if self.transform:
             ret = self.transform(ret)
         return ret
@@ -33,4 +45,4 @@ class RandomShift(object):
 
     def __call__(self, data):
         shift = random.randint(-self.max_shift, self.max_shift + 1)
-        return data[0] + shift, data[1] + shift
\ No newline at end of file
+        return data[0] + shift, data[1] + shift
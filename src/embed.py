@@ -0,0 +1,85 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+import numpy as np
+import torch
+
+from model import ScoreEncoder
+from train import NUM_ELEMENTS, HIDDEN_SIZE, NUM_LAYERS, KEY_SIZE, DROPOUT, CHECKPOINT_PATH, device
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from note_table import NoteTable, NOTE_TABLE, build_note_table
+from embedding_index import EmbeddingIndex, EMBEDDINGS
+
+MAX_LEN = 256 # longer pieces are embedded in chunks, so attention stays cheap
+
+
+def load_encoder(path=CHECKPOINT_PATH):
+    model = ScoreEncoder(NUM_ELEMENTS, HIDDEN_SIZE, NUM_LAYERS, KEY_SIZE, DROPOUT)
+    model.load_state_dict(torch.load(path, map_location=device)['model_state_dict'])
+    return model.to(device).eval()
+
+
+# one embedding per piece: the mean of the encoder's hidden states over all of its tokens
+# pieces are cut into chunks of at most max_len tokens, and chunks of similar length are padded into batches
+def embed_pieces(model, tokens, offsets, batch_size=64, max_len=MAX_LEN):
+    chunks = [] # (piece, start, end)
+    for piece, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+        for chunk_start in range(start, max(end, start + 1), max_len):
+            chunks.append((piece, chunk_start, min(chunk_start + max_len, end)))
+    chunks.sort(key=lambda c: c[2] - c[1])
+
+    sums = np.zeros((len(offsets) - 1, 2 * HIDDEN_SIZE), dtype=np.float64)
+    counts = np.zeros(len(offsets) - 1)
+    with torch.no_grad():
+        for i in range(0, len(chunks), batch_size):
+            batch = [c for c in chunks[i:i + batch_size] if c[2] > c[1]]
+            if not batch:
+                continue
+            width = max(end - start for _, start, end in batch)
+            x = torch.zeros((len(batch), width), dtype=torch.long)
+            mask = torch.zeros((len(batch), width), dtype=torch.bool)
+            for row, (_, start, end) in enumerate(batch):
+                x[row, :end - start] = torch.from_numpy(tokens[start:end].astype(np.int64))
+                mask[row, :end - start] = True
+            embeddings = model.embed(x.to(device), mask.to(device)).cpu().numpy()
+            for (piece, start, end), embedding in zip(batch, embeddings):
+                sums[piece] += embedding * (end - start)
+                counts[piece] += end - start
+    return (sums / np.maximum(counts, 1)[:, None]).astype(np.float32)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Embeds every piece with the trained ScoreEncoder and builds a cosine index over them')
+    parser.add_argument('--notes', default=NOTE_TABLE)
+    parser.add_argument('--checkpoint', default=CHECKPOINT_PATH)
+    parser.add_argument('-o', '--output', default=EMBEDDINGS)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--lists', type=int, default=None, help='IVF lists (0 for brute force; by default sqrt(n) for 1024 songs or more)')
+    parser.add_argument('--nprobe', type=int, default=8, help='lists searched per query')
+    parser.add_argument('--add', nargs='+', default=None, help='score files to add to an existing embedding index')
+    args = parser.parse_args()
+
+    if args.add:
+        index = EmbeddingIndex.load(args.output)
+        table = build_note_table(args.add)
+        tokens, offsets = table.token_classes()
+        vectors = embed_pieces(load_encoder(args.checkpoint), tokens, offsets, args.batch_size)
+        for name, vector in zip(table.names, vectors):
+            index.add(Path(name).name, vector)
+        index.save(args.output)
+        print('added %d pieces to %s, now %d' % (len(table), args.output, len(index)))
+        sys.exit(0)
+
+    table = NoteTable.load(args.notes)
+    tokens, offsets = table.token_classes()
+    model = load_encoder(args.checkpoint)
+
+    start = time.time()
+    vectors = embed_pieces(model, tokens, offsets, args.batch_size)
+    print('embedded %d pieces in %.1fs' % (len(vectors), time.time() - start))
+
+    index = EmbeddingIndex([Path(name).name for name in table.names], vectors, args.lists, args.nprobe)
+    index.save(args.output)
+    print('wrote %s' % args.output)
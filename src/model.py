@@ -2,6 +2,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 class SelfAttn(nn.Module):
     
@@ -11,17 +12,22 @@ class SelfAttn(nn.Module):
         self.wq = nn.Linear(value_size, key_size, bias=False)
         self.wk = nn.Linear(value_size, key_size, bias=False)
         self.wv = nn.Linear(value_size, value_size, bias=False)
-        self.softmax = nn.Softmax(dim=1)
+        self.softmax = nn.Softmax(dim=-1)
 
-    def forward(self, x_batched):
-        return torch.stack([self.attend(x) for x in x_batched])
+    # x_batched is (batch, seq, value_size); mask, if given, is (batch, seq) and False at padding,
+    # which is then never attended to
+    def forward(self, x_batched, mask=None):
+        queries = self.wq(x_batched)
+        keys = self.wk(x_batched)
+        values = self.wv(x_batched)
+        scores = torch.bmm(queries, keys.transpose(1, 2)) / self.sqrt_key_size
+        if mask is not None:
+            scores = scores.masked_fill(~mask[:, None, :], float('-inf'))
+        weights = self.softmax(scores)
+        return torch.bmm(weights, values)
 
     def attend(self, x):
-        queries = self.wq(x)
-        keys = self.wk(x)
-        values = self.wv(x)
-        weights = self.softmax(torch.mm(queries, keys.t()) / self.sqrt_key_size)
-        return torch.mm(weights, values)
+        return self.forward(x[None])[0]
 
 
 class ScoreEncoder(nn.Module):
@@ -36,12 +42,38 @@ class ScoreEncoder(nn.Module):
         self.linear = nn.Linear(2 * hidden_size, num_elements)
         self.softmax = nn.Softmax(dim=1)
 
-    def forward(self, x):
+    # hidden state of the top LSTM at every token, (batch, seq, 2 * hidden_size)
+    # mask, if given, is (batch, seq) and True for the tokens of each right-padded sequence
+    def encode(self, x, mask=None):
         embeddings = self.embedding(x)
-        output, _ = self.bi_lstm(embeddings)
-        output = self.self_attn(output)
-        output, _ = self.lstm(output)
-        output = output[:, -1, :].squeeze()
+        if mask is None:
+            output, _ = self.bi_lstm(embeddings)
+            output = self.self_attn(output)
+            output, _ = self.lstm(output)
+            return output
+        lengths = mask.sum(dim=1).cpu()
+        packed = pack_padded_sequence(embeddings, lengths, batch_first=True, enforce_sorted=False)
+        output, _ = pad_packed_sequence(self.bi_lstm(packed)[0], batch_first=True, total_length=x.shape[1])
+        output = self.self_attn(output, mask)
+        packed = pack_padded_sequence(output, lengths, batch_first=True, enforce_sorted=False)
+        output, _ = pad_packed_sequence(self.lstm(packed)[0], batch_first=True, total_length=x.shape[1])
+        return output
+
+    # one fixed-size vector per sequence: the mean of its hidden states over its real tokens
+    def embed(self, x, mask=None):
+        output = self.encode(x, mask)
+        if mask is None:
+            return output.mean(dim=1)
+        weights = mask.unsqueeze(2).to(output.dtype)
+        return (output * weights).sum(dim=1) / weights.sum(dim=1)
+
+    def forward(self, x, mask=None):
+        output = self.encode(x, mask)
+        if mask is None:
+            output = output[:, -1, :]
+        else:
+            # output at the last real token of each sequence
+            output = output[torch.arange(len(x)), mask.sum(dim=1) - 1]
         output = self.dropout(output)
         output = self.linear(output)
         return self.softmax(output)
@@ -1,80 +1,182 @@
-import pickle
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler
 
 from dataset import *
 from model import ScoreEncoder
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from note_table import NoteTable, NOTE_TABLE, NUM_CLASSES
+
 device = "cuda" if torch.cuda.is_available() else "cpu"
 device = torch.device(device)
-print('on device', device)
 CHECKPOINT_PATH = 'model/score-encoder.ckpt'
 
 
 # DEFINE MODEL HYPERPARAMETERS
-NUM_ELEMENTS = 111
+NUM_ELEMENTS = NUM_CLASSES
 HIDDEN_SIZE = 256
 NUM_LAYERS = 3
 KEY_SIZE = 128
+WINDOW_LEN = 30
 
 LR = 1e-3
 NUM_EPOCHS = 20
+BATCH_SIZE = 64
+VALID_FRACTION = 0.1
 loss_fn = nn.CrossEntropyLoss().to(device)
 DROPOUT = 0
 
 
-# LOAD TRAINING EXAMPLES
-with open('essen_data/snips.pickle', 'rb') as handle:
-    snips = pickle.load(handle)
-
-dataset = SnipsDataset(snips)
-train_data = DataLoader(dataset, batch_size=64, shuffle=True, num_workers=6)
+# the pieces held out for validation; the split depends only on the seed, so it survives a resume
+def split_pieces(num_pieces, valid_fraction, seed):
+    order = np.random.RandomState(seed).permutation(num_pieces)
+    num_valid = int(round(num_pieces * valid_fraction))
+    return np.sort(order[num_valid:]), np.sort(order[:num_valid])
 
 
-model = ScoreEncoder(NUM_ELEMENTS, HIDDEN_SIZE, NUM_LAYERS, KEY_SIZE, DROPOUT)
-optimizer = optim.Adam(model.parameters(), lr=LR)
+# batches of window indices for one epoch, in an order fixed by the seed and epoch,
+# so an epoch interrupted after skip_batches batches can carry on where it stopped
+def epoch_batches(dataset, batch_size, seed, epoch, skip_batches=0):
+    generator = torch.Generator().manual_seed(seed * 1000003 + epoch)
+    order = torch.randperm(len(dataset), generator=generator)[skip_batches * batch_size:]
+    return BatchSampler(order.tolist(), batch_size, drop_last=False)
 
-model = model.to(device)
 
-for epoch in range(NUM_EPOCHS):
-    total_loss = 0
-    model.train()
-    for i, data in enumerate(train_data):
-        if i % 500 == 0:
-            print('Epoch {} Batch {}'.format(epoch, i))
+# waits for queued GPU work so stage timings are not just kernel launch times
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
 
-        # get training inputs from corpus
-        inputs, outputs = data[0].to(device), data[1].to(device)
-        optimizer.zero_grad()
-        preds = model(inputs)
-        loss = loss_fn(preds, outputs)
-        total_loss += loss.item()
-        loss.backward()
-        optimizer.step()
 
+def save_checkpoint(path, model, optimizer, epoch, batches_done, total_loss, args):
+    tmp = '%s.tmp' % path
     torch.save({
             'epoch': epoch,
+            'batches_done': batches_done,
             'model_state_dict': model.state_dict(),
             'optimizer_state_dict': optimizer.state_dict(),
             'total_loss': total_loss,
-            }, CHECKPOINT_PATH)
-
-    print('Epoch %d, train loss=%.4f' % (epoch, total_loss / len(train_data)))
-
-    # TODO SET UP VALIDATION
-
-    # total_loss = 0
-    # model.eval()
-    # for i in range(len(corpus_valid)):
-    #     # get validation inputs from corpus
-    #     inputs, outputs = None, None
-
-    #     preds = model(inputs)
-    #     loss = loss_fn(preds, outputs)
-    #     total_loss += loss.item()
-
-    # print('Epoch %d, valid loss=%.4f' % (epoch, total_loss / len(valid_data)))
-
+            'seed': args.seed,
+            'valid_fraction': args.valid_fraction,
+            'window_len': args.window_len,
+            }, tmp)
+    os.replace(tmp, path) # never leave a half-written checkpoint behind
+
+
+# returns the epoch and batch to carry on from, and the loss so far in that epoch
+def load_checkpoint(path, model, optimizer, args):
+    checkpoint = torch.load(path, map_location=device)
+    for name in ('seed', 'valid_fraction', 'window_len'):
+        if name in checkpoint and checkpoint[name] != getattr(args, name):
+            print('warning: checkpoint was trained with %s=%s, now %s' % (name, checkpoint[name], getattr(args, name)))
+    model.load_state_dict(checkpoint['model_state_dict'])
+    optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    if checkpoint.get('batches_done') is None: # saved at the end of an epoch
+        return checkpoint['epoch'] + 1, 0, 0
+    return checkpoint['epoch'], checkpoint['batches_done'], checkpoint['total_loss']
+
+
+def evaluate(model, data):
+    total_loss, total = 0, 0
+    model.eval()
+    with torch.no_grad():
+        for inputs, outputs in data:
+            inputs, outputs = inputs.to(device), outputs.to(device)
+            total_loss += loss_fn(model(inputs), outputs).item() * len(outputs)
+            total += len(outputs)
+    return total_loss / max(total, 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Trains the ScoreEncoder on windows of the note table')
+    parser.add_argument('--notes', default=NOTE_TABLE)
+    parser.add_argument('--checkpoint', default=CHECKPOINT_PATH)
+    parser.add_argument('--no-resume', action='store_true', help='start from scratch even if the checkpoint exists')
+    parser.add_argument('--epochs', type=int, default=NUM_EPOCHS)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--window-len', type=int, default=WINDOW_LEN)
+    parser.add_argument('--valid-fraction', type=float, default=VALID_FRACTION, help='fraction of pieces held out for validation')
+    parser.add_argument('--workers', type=int, default=0, help='data loading processes (0 loads batches in the training process)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--log-every', type=int, default=500, help='batches between progress reports')
+    parser.add_argument('--checkpoint-every', type=int, default=1000, help='batches between mid-epoch checkpoints')
+    args = parser.parse_args()
+    print('on device', device)
+
+    # LOAD TRAINING EXAMPLES
+    tokens, offsets = NoteTable.load(args.notes).token_classes()
+    tokens = tokens.astype(np.int64) # shared by both splits
+    train_pieces, valid_pieces = split_pieces(len(offsets) - 1, args.valid_fraction, args.seed)
+    train_set = WindowDataset(tokens, offsets, args.window_len, pieces=train_pieces)
+    valid_set = WindowDataset(tokens, offsets, args.window_len, pieces=valid_pieces)
+    valid_data = DataLoader(valid_set, sampler=BatchSampler(range(len(valid_set)), args.batch_size, drop_last=False),
+                            batch_size=None, num_workers=args.workers)
+    print('%d training windows from %d pieces, %d validation windows from %d pieces' % (len(train_set), len(train_pieces), len(valid_set), len(valid_pieces)))
+
+    torch.manual_seed(args.seed)
+    model = ScoreEncoder(NUM_ELEMENTS, HIDDEN_SIZE, NUM_LAYERS, KEY_SIZE, DROPOUT)
+    model = model.to(device)
+    optimizer = optim.Adam(model.parameters(), lr=LR)
+
+    start_epoch, skip_batches, total_loss = 0, 0, 0
+    if os.path.exists(args.checkpoint) and not args.no_resume:
+        start_epoch, skip_batches, total_loss = load_checkpoint(args.checkpoint, model, optimizer, args)
+        print('resuming from %s at epoch %d, batch %d' % (args.checkpoint, start_epoch, skip_batches))
+    Path(args.checkpoint).parent.mkdir(parents=True, exist_ok=True)
+
+    num_batches = (len(train_set) + args.batch_size - 1) // args.batch_size
+    for epoch in range(start_epoch, args.epochs):
+        # whole batches are fetched with one index into the dataset instead of one window at a time
+        train_data = DataLoader(train_set, sampler=epoch_batches(train_set, args.batch_size, args.seed, epoch, skip_batches),
+                                batch_size=None, num_workers=args.workers)
+        stage_times = {'data': 0.0, 'forward': 0.0, 'backward': 0.0, 'step': 0.0}
+        samples = 0
+        epoch_start = last = time.perf_counter()
+        model.train()
+        for i, data in enumerate(train_data, skip_batches):
+            # get training inputs from corpus
+            inputs, outputs = data[0].to(device), data[1].to(device)
+            sync()
+            now = time.perf_counter(); stage_times['data'] += now - last; last = now
+
+            optimizer.zero_grad()
+            preds = model(inputs)
+            loss = loss_fn(preds, outputs)
+            total_loss += loss.item()
+            now = time.perf_counter(); stage_times['forward'] += now - last; last = now
+
+            loss.backward()
+            sync()
+            now = time.perf_counter(); stage_times['backward'] += now - last; last = now
+
+            optimizer.step()
+            sync()
+            now = time.perf_counter(); stage_times['step'] += now - last; last = now
+            samples += len(outputs)
+
+            if (i + 1) % args.log_every == 0:
+                elapsed = now - epoch_start
+                print('Epoch %d Batch %d/%d, train loss=%.4f, %.1f samples/s (%s)' % (
+                    epoch, i + 1, num_batches, total_loss / (i + 1), samples / elapsed,
+                    ', '.join('%s %.0f%%' % (stage, 100 * t / elapsed) for stage, t in stage_times.items())))
+            if (i + 1) % args.checkpoint_every == 0 and i + 1 < num_batches:
+                save_checkpoint(args.checkpoint, model, optimizer, epoch, i + 1, total_loss, args)
+
+        elapsed = time.perf_counter() - epoch_start
+        save_checkpoint(args.checkpoint, model, optimizer, epoch, None, total_loss, args)
+        print('Epoch %d, train loss=%.4f, %.1f samples/s, %.1fs (%s)' % (
+            epoch, total_loss / max(num_batches, 1), samples / elapsed, elapsed,
+            ', '.join('%s %.1fs' % (stage, t) for stage, t in stage_times.items())))
+
+        valid_start = time.perf_counter()
+        print('Epoch %d, valid loss=%.4f (%.1fs)' % (epoch, evaluate(model, valid_data), time.perf_counter() - valid_start))
+        skip_batches, total_loss = 0, 0
@@ -0,0 +1,187 @@
+import argparse
+
+import numpy as np
+
+TOPK_INDEX = 'all_pairs_similarity.topk.npz'
+K = 50
+
+
+"""
+The k highest scores along the last axis of a row of scores or a (rows x n) array of them, as (indices, scores)
+sorted best first. Every top k of the index builders and the recommenders is taken here, so they all rank the
+same way: missing (nan) scores count as -inf, and ties keep the order argpartition leaves them in
+"""
+def topk_entries(scores, k):
+    if np.isnan(scores).any():
+        scores = np.where(np.isnan(scores), -np.inf, scores)
+    k = min(k, scores.shape[-1])
+    part = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    if scores.ndim == 1: #plain indexing, much cheaper than take_along_axis for the one row of a recommendation step
+        part_scores = scores[part]
+        order = np.argsort(-part_scores, kind='stable')
+        return part[order], part_scores[order]
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind='stable')
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+
+"""
+The k highest-scoring entries of each row of a (rows x n) block, excluding the ones at exclude,
+as (neighbours, scores) sorted best first. Missing (nan) scores never count as neighbours.
+The block is changed in place
+"""
+def _topk_rows(block, k, exclude):
+    block[np.arange(len(block)), exclude] = -np.inf
+    return topk_entries(block, k)
+
+
+"""
+Top-k neighbour index from a full (n x n) similarity matrix, e.g. a memory-mapped similarity store.
+Rows are read block_size at a time so the matrix never has to be in memory at once
+"""
+def build_topk_index(matrix, k=K, block_size=1024):
+    n = matrix.shape[0]
+    k = min(k, n - 1)
+    neighbours = np.empty((n, k), dtype=np.int32)
+    scores = np.empty((n, k), dtype=np.float32)
+    for start in range(0, n, block_size):
+        rows = np.arange(start, min(start + block_size, n))
+        neighbours[rows], scores[rows] = _topk_rows(np.array(matrix[rows[0]:rows[-1] + 1], dtype=np.float64), k, rows)
+    return neighbours, scores
+
+
+"""
+Top-k neighbour index straight from feature records, without ever building the full matrix.
+Each block of rows is scored in two stages (see similarity_matrix.top_similar), so most pairs never get their
+melodic arches compared. weights is a weight profile, as for similarity(), without negative weights
+"""
+def build_topk_index_from_features(features: list, k=K, block_size=64, weights=None):
+    from similarity_matrix import pack_features, top_similar
+
+    packed = pack_features(features)
+    n = packed['size']
+    k = min(k, n - 1)
+    neighbours = np.empty((n, k), dtype=np.int32)
+    scores = np.empty((n, k), dtype=np.float32)
+    cols = np.arange(n)
+    for start in range(0, n, block_size):
+        rows = np.arange(start, min(start + block_size, n))
+        neighbours[rows], scores[rows] = top_similar(packed, rows, cols, k, exclude=rows, weights=weights)
+    return neighbours, scores
+
+
+"""
+Brings a top-k index up to date after the pieces at updated got new scores (or were just added at the end of
+the matrix) and the pieces at removed became tombstones, without rebuilding it.
+Rows of updated and removed pieces, and rows whose neighbours included one of them, are rebuilt from the matrix;
+every other row only has to consider the updated pieces as new neighbours.
+Returns the new (neighbours, scores), grown to the matrix's size
+"""
+def update_topk_index(neighbours, scores, matrix, updated, removed=(), block_size=1024):
+    n, k = matrix.shape[0], neighbours.shape[1]
+    updated, removed = np.asarray(updated, dtype=np.int64), np.asarray(removed, dtype=np.int64)
+    if n > len(neighbours):
+        neighbours = np.vstack([neighbours, np.zeros((n - len(neighbours), k), dtype=neighbours.dtype)])
+        scores = np.vstack([scores, np.full((n - len(scores), k), -np.inf, dtype=scores.dtype)])
+    else:
+        neighbours, scores = neighbours.copy(), scores.copy()
+
+    changed = np.union1d(updated, removed)
+    stale = (np.isin(neighbours, changed) & np.isfinite(scores)).any(axis=1)
+    rebuild = np.union1d(np.flatnonzero(stale), changed)
+    for start in range(0, len(rebuild), block_size):
+        rows = rebuild[start:start + block_size]
+        neighbours[rows], scores[rows] = _topk_rows(np.array(matrix[rows], dtype=np.float64), k, rows)
+
+    others = np.setdiff1d(np.arange(n), rebuild)
+    for start in range(0, len(others) if len(updated) else 0, block_size):
+        rows = others[start:start + block_size]
+        candidates = np.hstack([neighbours[rows], np.broadcast_to(updated, (len(rows), len(updated)))])
+        candidate_scores = np.hstack([scores[rows], np.array(matrix[np.ix_(rows, updated)], dtype=np.float64)])
+        best, scores[rows] = topk_entries(candidate_scores, k)
+        neighbours[rows] = np.take_along_axis(candidates, best, axis=1)
+    return neighbours, scores
+
+
+def save_topk_index(path, names: list, neighbours, scores):
+    np.savez(path, names=np.array(names), neighbours=neighbours, scores=scores)
+
+"""
+Returns the piece names, and each piece's neighbours and their scores as (n x k) arrays, best first
+"""
+def load_topk_index(path):
+    with np.load(path) as index:
+        return list(index['names']), index['neighbours'], index['scores']
+
+
+"""
+Recency-weighted preferences that only ever touch the neighbours of the songs the user liked.
+Halving every preference is done lazily by tracking a common scale, so a like costs O(k), not O(n).
+Songs outside every liked song's neighbours keep a preference of 0.
+A dislike needs the whole row of the disliked song: its neighbours say which songs to move away from, but not
+which songs are the least like it, so with only them every other song would tie at 0. similarity gives those rows,
+e.g. a memory-mapped similarity store, and dislikes subtract them like the dense recommender does
+"""
+class SparsePreferences(object):
+
+    def __init__(self, size, similarity=None):
+        self.prefs = np.zeros(size)
+        self.scale = 1.0 #true preferences are prefs * scale
+        self.similarity = similarity
+
+    def copy(self):
+        other = SparsePreferences(0, self.similarity)
+        other.prefs = self.prefs.copy()
+        other.scale = self.scale
+        return other
+
+    def update(self, neighbours, scores, curr, liked):
+        self.scale /= 2
+        if self.scale < 1e-100: #fold the scale back in before it underflows
+            self.prefs *= self.scale
+            self.scale = 1.0
+        if not liked and self.similarity is not None:
+            self.prefs -= np.nan_to_num(np.asarray(self.similarity[curr], dtype=np.float64)) / self.scale
+        else:
+            found = np.isfinite(scores[curr]) #rows with fewer than k scored pairs are padded with -inf
+            self.prefs[neighbours[curr][found]] += scores[curr][found].astype(np.float64) * ((1 if liked else -1) / self.scale)
+        self.prefs[curr] = -np.inf
+
+    """
+    Rules songs out for good, e.g. pieces removed from the corpus
+    """
+    def exclude(self, songs):
+        self.prefs[songs] = -np.inf
+
+    def top(self, k=3):
+        return topk_entries(self.prefs, k)[0]
+
+    def values(self):
+        return self.prefs * self.scale
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Builds the top-k neighbour index used for recommendations')
+    parser.add_argument('--store', default='all_pairs_similarity.sim', help='similarity store to build from')
+    parser.add_argument('--features', default=None, help='build from this feature store instead of a similarity store')
+    parser.add_argument('--weights', default=None, help='JSON weight profile, {component: weight}, to score the features with')
+    parser.add_argument('-k', type=int, default=K)
+    parser.add_argument('-o', '--output', default=TOPK_INDEX)
+    args = parser.parse_args()
+    if args.weights and not args.features:
+        parser.error('--weights needs --features; a similarity store is already scored')
+
+    if args.features:
+        from pathlib import Path
+        from build_features import load_feature_store
+        paths, features = load_feature_store(args.features)
+        names = [Path(path).name for path in paths]
+        from functions import load_weights
+        weights = load_weights(args.weights) if args.weights else None
+        neighbours, scores = build_topk_index_from_features(features, args.k, weights=weights)
+    else:
+        from similarity_store import load_similarity_store
+        names, matrix = load_similarity_store(args.store)
+        neighbours, scores = build_topk_index(matrix, args.k)
+    save_topk_index(args.output, names, neighbours, scores)
+    print('wrote %d neighbours for each of %d pieces to %s' % (neighbours.shape[1], len(names), args.output))
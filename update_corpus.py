@@ -0,0 +1,132 @@
+import argparse
+import json
+import os
+import pickle
+import time
+from pathlib import Path
+
+import numpy as np
+
+from build_features import STORE_DIR, build_feature_store, feature_path
+from similarity_matrix import pack_features, similarity_block
+from similarity_store import TOMBSTONE, load_similarity_store, grow_similarity_store, read_header, write_similarity_store_names
+from topk_index import TOPK_INDEX, load_topk_index, save_topk_index, update_topk_index
+
+SIMILARITY_STORE = 'all_pairs_similarity.sim'
+
+
+"""
+The sidecar file recording which version (content hash) of each piece a similarity store was computed from
+"""
+def digests_path(store_path):
+    return '%s.digests.json' % store_path
+
+
+def load_store_digests(store_path):
+    if not os.path.exists(digests_path(store_path)):
+        return dict()
+    with open(digests_path(store_path)) as f:
+        return json.load(f)
+
+
+def save_store_digests(store_path, digests: dict):
+    tmp = digests_path(store_path) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(digests, f, indent=0)
+    os.replace(tmp, digests_path(store_path))
+
+
+"""
+The weight profile a similarity store was scored with; stores that do not record one were scored with the defaults.
+Raises ValueError if weights, a weight profile, is given and is not that one
+"""
+def store_weight_profile(store_path, weights=None):
+    from functions import weight_list, weight_profile
+
+    recorded = read_header(store_path)['weights']
+    profile = weight_profile(recorded) if recorded else None
+    if weights is not None and weight_list(weights) != weight_list(profile):
+        raise ValueError('%s was scored with the weights %s, not %s; score it again with similarity_matrix.py --weights'
+                         % (store_path, weight_profile(weight_list(profile)), weight_profile(weight_list(weights))))
+    return profile
+
+
+"""
+The pieces in a feature store index, by the name the similarity store uses for them
+"""
+def digests_by_name(index: dict):
+    return {Path(path).name: digest for path, digest in sorted(index.items())}
+
+
+"""
+Brings a similarity store (and its top-k index, if there is one) up to date with the scores under dirs.
+Only new and changed pieces are extracted and scored, against every piece in the store, so adding m pieces
+to n costs O(m n) similarities. New pieces are appended, changed ones are rescored in their own slot and
+pieces whose files are gone become tombstones.
+Pieces whose version the store does not know (stores built before digests were recorded) are assumed up to date.
+New scores use the weights the store records (see store_weight_profile); weights, if given, must be those
+"""
+def update_corpus(dirs, store_path=SIMILARITY_STORE, feature_dir=STORE_DIR, topk_path=TOPK_INDEX, block_size=256, weights=None):
+    weights = store_weight_profile(store_path, weights)
+    index = build_feature_store(dirs, feature_dir)
+    current = digests_by_name(index)
+    names, _ = load_similarity_store(store_path)
+    known = load_store_digests(store_path)
+
+    slots = {name: i for i, name in enumerate(names) if name != TOMBSTONE}
+    removed = sorted(slots[name] for name in slots if name not in current)
+    changed = sorted(slots[name] for name in slots if name in current and known.get(name, current[name]) != current[name])
+    added = sorted(name for name in current if name not in slots)
+    print('%d new, %d changed, %d removed pieces' % (len(added), len(changed), len(removed)))
+    if not (added or changed or removed):
+        return names
+
+    start = time.time()
+    names, matrix = grow_similarity_store(store_path, added)
+    for slot in removed:
+        names[slot] = TOMBSTONE
+        matrix[slot, :] = np.nan
+        matrix[:, slot] = np.nan
+    write_similarity_store_names(store_path, names)
+
+    live = np.array([i for i, name in enumerate(names) if name != TOMBSTONE], dtype=np.int64)
+    features = []
+    for slot in live:
+        with open(feature_path(feature_dir, current[names[slot]]), 'rb') as handle:
+            features.append(pickle.load(handle))
+    packed = pack_features(features)
+    position = {slot: p for p, slot in enumerate(live)}
+    updated = np.array(changed + list(range(len(names) - len(added), len(names))), dtype=np.int64)
+    cols = np.arange(len(live))
+    for start_row in range(0, len(updated), block_size):
+        rows = updated[start_row:start_row + block_size]
+        block = similarity_block(packed, [position[slot] for slot in rows], cols, weights)
+        matrix[np.ix_(rows, live)] = block
+        matrix[np.ix_(live, rows)] = block.T
+    matrix.flush()
+    save_store_digests(store_path, {name: current[name] for name in names if name != TOMBSTONE})
+    print('scored %d pieces against %d in %.1fs' % (len(updated), len(live), time.time() - start))
+
+    if topk_path and os.path.exists(topk_path):
+        _, neighbours, scores = load_topk_index(topk_path)
+        neighbours, scores = update_topk_index(neighbours, scores, matrix, updated, removed)
+        save_topk_index(topk_path, names, neighbours, scores)
+        print('updated %s' % topk_path)
+    return names
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Adds new and changed scores to the similarity store and top-k index, and removes deleted ones')
+    parser.add_argument('dirs', nargs='*', default=['essen', 'piano'])
+    parser.add_argument('--store', default=SIMILARITY_STORE)
+    parser.add_argument('--features', default=STORE_DIR)
+    parser.add_argument('--topk', default=TOPK_INDEX)
+    parser.add_argument('--weights', default=None, help='JSON weight profile the store must have been scored with (default: whichever it records)')
+    args = parser.parse_args()
+    weights = None
+    if args.weights:
+        from functions import load_weights
+        weights = load_weights(args.weights)
+
+    names = update_corpus(args.dirs, args.store, args.features, args.topk, weights=weights)
+    print('%d pieces in %s' % (sum(1 for name in names if name != TOMBSTONE), args.store))